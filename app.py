@@ -1,16 +1,28 @@
 ### Import Required Packages
+# pandas, NumPy and matplotlib are not imported here: the generated code runs in the sandbox workers, which preload
+# them, and the app only needs pandas for the SQL results (imported by the background warmup, see startup.py).
 import os
+import time
+import asyncio
+import contextvars
 import openai
 import sqlite3
-import numpy as np
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_experimental.utilities import PythonREPL
-from langchain_core.tools import Tool
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from langchain_openai import ChatOpenAI
+from schema_retrieval import SchemaRetriever
+from llm_cache import ResponseCache
+from sandbox import SandboxPool
+from query_runner import QueryRejected, QueryRunner, clean_sql
+from tracing import TokenCounter, finish_trace, metrics_text, record_value, stage, start_trace
+from startup import prefetch_files, warm_up_in_background
+from cube import CUBE_PATH
 
 
 # Read OpenAI key from Codespaces Secrets
@@ -18,8 +30,46 @@ api_key = os.environ['OPENAI_KEY']             # <-- change this as per your Cod
 os.environ['OPENAI_API_KEY'] = api_key
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
-# Load Model
-llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0)
+# Client-side limits of the OpenAI calls: requests per minute across all requests (0: no limit, set it below the
+# account's rate limit for batch runs), and retries with exponential backoff of rate-limited or failed calls
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get('LLM_REQUESTS_PER_MINUTE', 0))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+rate_limiter = (InMemoryRateLimiter(requests_per_second=LLM_REQUESTS_PER_MINUTE / 60, check_every_n_seconds=0.05)
+                if LLM_REQUESTS_PER_MINUTE > 0 else None)
+
+# Load Model, the prompt and completion tokens of every call are added to the request trace (see tracing.py)
+llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0, stream_usage=True, callbacks=[TokenCounter()],
+                 max_retries=LLM_MAX_RETRIES, rate_limiter=rate_limiter)
+
+# 'single': route a request and write its SQL query and analysis code in one structured LLM call (default),
+# 'chain': classification, SQL and code generation as three sequential calls (also the fallback of 'single')
+ROUTER_MODE = os.environ.get('ROUTER_MODE', 'single')
+
+# Attempts at a SQL query for one request: a query refused by the cost guard (or by SQLite) is regenerated with the reason
+SQL_ATTEMPTS = int(os.environ.get('SQL_ATTEMPTS', 2))
+
+# Table definitions for the prompts, read from the DB so they always match the column types stored by main.py.
+# Only the tables and columns relevant to each request are sent (see schema_retrieval.py), the full schema is
+# thousands of tokens per call. The same request is described once for all the chains.
+# The schema is embedded in the background (the embedding model takes seconds to load), the first request waits for it.
+schema_retriever = SchemaRetriever('stock_db.sqlite', background=True)
+describe_schema = lru_cache(maxsize=1024)(schema_retriever.describe)
+with_schema = RunnablePassthrough.assign(schema=lambda inputs: describe_schema(inputs["request"]))
+
+# Persistent cache of chain responses ('llm_cache.sqlite'), invalidated whenever main.py reloads the DB
+response_cache = ResponseCache(db_path='stock_db.sqlite')
+
+
+### Instructions shared by the chain prompts and the single-call routing prompt, so the two paths cannot drift apart.
+# They are filled in as partial variables (part of the cache key, see `cached`).
+ROLLUP_HINT = """For trends over long periods or at weekly, monthly or yearly granularity (e.g. "monthly close of RELIANCE since 2000"), query the prices_weekly, prices_monthly or prices_yearly tables instead of the daily stock_prices rows."""
+
+PLOT_HINT = """If the insights contain a figure or plot, draw it with matplotlib; figures are captured automatically, there is no need to save them to a file."""
+
+CUBE_HINT = """For questions across many symbols or long date ranges of daily prices, use the memory-mapped price cube instead of loading rows from the database:
+`from cube import PriceCube; cube = PriceCube()`, then `cube.view('close', start='2019-06-01', end='2024-06-01')` returns a (symbol x trading day) numpy array
+(fields: open, high, low, close, volume; rows in the order of `cube.symbols`; columns are the dates `cube.dates_between(start, end)`; NaN where there is no price),
+and `cube.view('close', symbol='RELIANCE', start=...)` returns the series of one symbol."""
 
 
 ### Create Chain for Classifying user request as `Need SQL`, `Non SQL`, or `Other`
@@ -31,10 +81,7 @@ If the user request does not requires any data to be fetched from the database b
 If the user request looks out of the context then classify it as `Other`.
 
 The databse has following tables:
-CREATE TABLE IF NOT EXISTS stock_prices (date DATE, open DOUBLE, high DOUBLE, low DOUBLE, close DOUBLE, volume INT, symbol VARCHAR(20));
-CREATE TABLE IF NOT EXISTS income_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), revenue INTEGER, costOfRevenue INTEGER, grossProfit INTEGER, grossProfitRatio DOUBLE, researchAndDevelopmentExpenses INTEGER, generalAndAdministrativeExpenses INTEGER, sellingAndMarketingExpenses INTEGER, sellingGeneralAndAdministrativeExpenses INTEGER, otherExpenses INTEGER, operatingExpenses INTEGER, costAndExpenses INTEGER, interestIncome INTEGER, interestExpense INTEGER, depreciationAndAmortization INTEGER, ebitda INTEGER, ebitdaratio DOUBLE, operatingIncome INTEGER, operatingIncomeRatio DOUBLE, totalOtherIncomeExpensesNet INTEGER, incomeBeforeTax INTEGER, incomeBeforeTaxRatio DOUBLE, incomeTaxExpense INTEGER, netIncome INTEGER, netIncomeRatio DOUBLE, eps DOUBLE, epsdiluted DOUBLE, weightedAverageShsOut INTEGER, weightedAverageShsOutDil INTEGER );
-CREATE TABLE IF NOT EXISTS balancesheet_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), cashAndCashEquivalents INTEGER, shortTermInvestments INTEGER, cashAndShortTermInvestments INTEGER, netReceivables INTEGER, inventory INTEGER, otherCurrentAssets INTEGER, totalCurrentAssets INTEGER, propertyPlantEquipmentNet INTEGER, goodwill INTEGER, intangibleAssets INTEGER, goodwillAndIntangibleAssets INTEGER, longTermInvestments INTEGER, taxAssets INTEGER, otherNonCurrentAssets INTEGER, totalNonCurrentAssets INTEGER, otherAssets INTEGER, totalAssets INTEGER, accountPayables INTEGER, shortTermDebt INTEGER, taxPayables INTEGER, deferredRevenue INTEGER, otherCurrentLiabilities INTEGER, totalCurrentLiabilities INTEGER, longTermDebt INTEGER, deferredRevenueNonCurrent INTEGER, deferredTaxLiabilitiesNonCurrent INTEGER, otherNonCurrentLiabilities INTEGER, totalNonCurrentLiabilities INTEGER, otherLiabilities INTEGER, capitalLeaseObligations INTEGER, totalLiabilities VARCHAR(20), preferredStock VARCHAR(20), commonStock VARCHAR(20), retainedEarnings VARCHAR(20), accumulatedOtherComprehensiveIncomeLoss VARCHAR(20), othertotalStockholdersEquity VARCHAR(20), totalStockholdersEquity VARCHAR(20), totalEquity VARCHAR(20), totalLiabilitiesAndStockholdersEquity VARCHAR(20), minorityInterest VARCHAR(20), totalLiabilitiesAndTotalEquity VARCHAR(20), totalInvestments VARCHAR(20), totalDebt VARCHAR(20), netDebt VARCHAR(20) ); 
-CREATE TABLE IF NOT EXISTS cashflow_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), netIncome INTEGER, depreciationAndAmortization INTEGER, deferredIncomeTax INTEGER, stockBasedCompensation INTEGER, changeInWorkingCapital INTEGER, accountsReceivables INTEGER, inventory INTEGER, accountsPayables INTEGER, otherWorkingCapital INTEGER, otherNonCashItems INTEGER, netCashProvidedByOperatingActivities INTEGER, investmentsInPropertyPlantAndEquipment INTEGER, acquisitionsNet INTEGER, purchasesOfInvestments INTEGER, salesMaturitiesOfInvestments INTEGER, otherInvestingActivites INTEGER, netCashUsedForInvestingActivites INTEGER, debtRepayment INTEGER, commonStockIssued INTEGER, commonStockRepurchased INTEGER, dividendsPaid INTEGER, otherFinancingActivites INTEGER, netCashUsedProvidedByFinancingActivities INTEGER, effectOfForexChangesOnCash INTEGER, netChangeInCash INTEGER, cashAtEndOfPeriod INTEGER, cashAtBeginningOfPeriod INTEGER, operatingCashFlow INTEGER, capitalExpenditure INTEGER, freeCashFlow INTEGER ); 
+{schema}
 The 'symbol' column in each table contains the companies names in capital letters.
 
 Do not respond with more than two words.
@@ -43,10 +90,11 @@ Request: {request}
 Classification:
 """
 
-PROMPT0 = PromptTemplate(input_variables=["request"], template=template0)
+PROMPT0 = PromptTemplate(input_variables=["request", "schema"], template=template0)
 
 # Classification Chain
-clf_chain = (PROMPT0
+clf_chain = (with_schema
+             | PROMPT0
              | llm
              | StrOutputParser()       # to get output in a more usable format
              )
@@ -65,6 +113,7 @@ Never query for all columns from a table. You must query only the columns that a
 Pay attention to use only the column names you can see in the tables below. Be careful to not query for columns that do not exist. Also, pay attention to which column is in which table.
 Pay attention to use date('now') function to get the current date, if the question involves "today".
 Do not return any new columns nor perform aggregation on columns. Return only the columns present in tables and further aggregations will be done by python code in later steps.
+{rollup_hint}
 The databse currently have data of Nifty 50 constituents, and the symbol column includes the ticker representing the stock.
 Once you start generating sql queries make sure that you only use correct ticker symbol for filtering and restrict yourself to use only current Nifty 50 constituents.
 
@@ -74,20 +123,20 @@ Request: Request here
 SQLQuery: Generated SQL Query here
 
 Only use the following tables:
-CREATE TABLE IF NOT EXISTS stock_prices (date DATE, open DOUBLE, high DOUBLE, low DOUBLE, close DOUBLE, volume INT, symbol VARCHAR(20));
-CREATE TABLE IF NOT EXISTS income_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), revenue INTEGER, costOfRevenue INTEGER, grossProfit INTEGER, grossProfitRatio DOUBLE, researchAndDevelopmentExpenses INTEGER, generalAndAdministrativeExpenses INTEGER, sellingAndMarketingExpenses INTEGER, sellingGeneralAndAdministrativeExpenses INTEGER, otherExpenses INTEGER, operatingExpenses INTEGER, costAndExpenses INTEGER, interestIncome INTEGER, interestExpense INTEGER, depreciationAndAmortization INTEGER, ebitda INTEGER, ebitdaratio DOUBLE, operatingIncome INTEGER, operatingIncomeRatio DOUBLE, totalOtherIncomeExpensesNet INTEGER, incomeBeforeTax INTEGER, incomeBeforeTaxRatio DOUBLE, incomeTaxExpense INTEGER, netIncome INTEGER, netIncomeRatio DOUBLE, eps DOUBLE, epsdiluted DOUBLE, weightedAverageShsOut INTEGER, weightedAverageShsOutDil INTEGER );
-CREATE TABLE IF NOT EXISTS balancesheet_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), cashAndCashEquivalents INTEGER, shortTermInvestments INTEGER, cashAndShortTermInvestments INTEGER, netReceivables INTEGER, inventory INTEGER, otherCurrentAssets INTEGER, totalCurrentAssets INTEGER, propertyPlantEquipmentNet INTEGER, goodwill INTEGER, intangibleAssets INTEGER, goodwillAndIntangibleAssets INTEGER, longTermInvestments INTEGER, taxAssets INTEGER, otherNonCurrentAssets INTEGER, totalNonCurrentAssets INTEGER, otherAssets INTEGER, totalAssets INTEGER, accountPayables INTEGER, shortTermDebt INTEGER, taxPayables INTEGER, deferredRevenue INTEGER, otherCurrentLiabilities INTEGER, totalCurrentLiabilities INTEGER, longTermDebt INTEGER, deferredRevenueNonCurrent INTEGER, deferredTaxLiabilitiesNonCurrent INTEGER, otherNonCurrentLiabilities INTEGER, totalNonCurrentLiabilities INTEGER, otherLiabilities INTEGER, capitalLeaseObligations INTEGER, totalLiabilities VARCHAR(20), preferredStock VARCHAR(20), commonStock VARCHAR(20), retainedEarnings VARCHAR(20), accumulatedOtherComprehensiveIncomeLoss VARCHAR(20), othertotalStockholdersEquity VARCHAR(20), totalStockholdersEquity VARCHAR(20), totalEquity VARCHAR(20), totalLiabilitiesAndStockholdersEquity VARCHAR(20), minorityInterest VARCHAR(20), totalLiabilitiesAndTotalEquity VARCHAR(20), totalInvestments VARCHAR(20), totalDebt VARCHAR(20), netDebt VARCHAR(20) ); 
-CREATE TABLE IF NOT EXISTS cashflow_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), netIncome INTEGER, depreciationAndAmortization INTEGER, deferredIncomeTax INTEGER, stockBasedCompensation INTEGER, changeInWorkingCapital INTEGER, accountsReceivables INTEGER, inventory INTEGER, accountsPayables INTEGER, otherWorkingCapital INTEGER, otherNonCashItems INTEGER, netCashProvidedByOperatingActivities INTEGER, investmentsInPropertyPlantAndEquipment INTEGER, acquisitionsNet INTEGER, purchasesOfInvestments INTEGER, salesMaturitiesOfInvestments INTEGER, otherInvestingActivites INTEGER, netCashUsedForInvestingActivites INTEGER, debtRepayment INTEGER, commonStockIssued INTEGER, commonStockRepurchased INTEGER, dividendsPaid INTEGER, otherFinancingActivites INTEGER, netCashUsedProvidedByFinancingActivities INTEGER, effectOfForexChangesOnCash INTEGER, netChangeInCash INTEGER, cashAtEndOfPeriod INTEGER, cashAtBeginningOfPeriod INTEGER, operatingCashFlow INTEGER, capitalExpenditure INTEGER, freeCashFlow INTEGER ); 
+{schema}
 The 'symbol' column in each table contains the companies names in capital letters.
 
 Request: {request}
+{hint}
 SQLQuery:
 """
 
-PROMPT1 = PromptTemplate(input_variables=["request"], template=template1)
+PROMPT1 = PromptTemplate(input_variables=["request", "schema"], template=template1,
+                         partial_variables={"hint": "", "rollup_hint": ROLLUP_HINT})
 
 # SQL Query Generation Chain
-sql_chain = (PROMPT1
+sql_chain = (with_schema
+             | PROMPT1
              | llm
              | StrOutputParser()       # to get output in a more usable format
              )
@@ -97,22 +146,40 @@ sql_chain = (PROMPT1
 # print(response1)
 
 
-### Python tool for code execution
-python_repl = PythonREPL()
-repl_tool = Tool(
-    name="python_repl",
-    description="A Python shell. Use this to execute python commands. Input should be a valid python command. If you want to see the output of a value, you should print it out with `print(...)`.",
-    func=python_repl.run,
+### Sandboxed worker processes for code execution
+# Pre-warmed with pandas / NumPy / matplotlib and a read-only DB connection, each snippet runs with CPU time,
+# wall-clock and memory limits (SANDBOX_WORKERS, SANDBOX_CPU_SECONDS, SANDBOX_WALL_SECONDS, SANDBOX_MEMORY_MB).
+execution_pool = SandboxPool()
+
+# Generated code runs off the event loop, one thread waits on each busy worker
+repl_executor = ThreadPoolExecutor(max_workers=execution_pool.size, thread_name_prefix="sandbox")
+
+
+### Generated SQL is run by the app itself on pooled read-only connections (SQL_POOL_SIZE), and the resulting
+# DataFrames are cached by normalised SQL until main.py reloads the DB (SQL_RESULT_CACHE_ENTRIES).
+# Costly queries are refused from their plan, or stopped past SQL_MAX_VM_STEPS / SQL_MAX_SECONDS / SQL_MAX_ROWS.
+query_runner = QueryRunner('stock_db.sqlite')
+sql_executor = ThreadPoolExecutor(max_workers=query_runner.pool_size, thread_name_prefix="sql")
+
+
+### Warm up in the background while Chainlit starts accepting connections: the DB and price cube files are read
+# into the page cache, the SQL connections opened (and pandas imported), the schema embedded. The sandbox workers are
+# already loading, in parallel, since the pool was created.
+warm_up_in_background(
+    ("page cache", lambda: prefetch_files(['stock_db.sqlite', CUBE_PATH])),
+    ("SQL connections", query_runner.warmup),
+    ("schema embeddings", schema_retriever.wait),
 )
-repl_tool.run("1+1")
 
 
 ### Create Chain for Insights Generation
 # Build prompt
 template2 = """
-Use the following pieces of user request and sql query to generate python code that should first load the required data from 'stock_db.sqlite' database and 
-then show insights related to that data. If the generated insights contains a figure or plot then that should be saved inside the 'figures' directory.
+Use the following pieces of user request and sql query to generate python code that shows insights related to the data returned by the query.
+The rows returned by the sql query are already loaded in a pandas DataFrame named `df` (described below), use it directly: do not connect to the database or run the query again.
+{plot_hint}
 If there is some tables or numerical values as insights then those should be printed out explicitely using print statement along with their description.
+{cube_hint}
 Generate and return python code only, no additional text.
 If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
@@ -121,7 +188,8 @@ If you don't know the answer, just say that you don't know, don't try to make up
 Generate code:
 """
 
-PROMPT2 = PromptTemplate(input_variables=["request_plus_sqlquery"], template=template2)
+PROMPT2 = PromptTemplate(input_variables=["request_plus_sqlquery"], template=template2,
+                         partial_variables={"plot_hint": PLOT_HINT, "cube_hint": CUBE_HINT})
 
 # Code Generation Chain
 code_chain = (PROMPT2
@@ -138,10 +206,7 @@ Suggestion should not be more than 4 lines.
 If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
 SQLite database has following tables:
-CREATE TABLE IF NOT EXISTS stock_prices (date DATE, open DOUBLE, high DOUBLE, low DOUBLE, close DOUBLE, volume INT, symbol VARCHAR(20));
-CREATE TABLE IF NOT EXISTS income_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), revenue INTEGER, costOfRevenue INTEGER, grossProfit INTEGER, grossProfitRatio DOUBLE, researchAndDevelopmentExpenses INTEGER, generalAndAdministrativeExpenses INTEGER, sellingAndMarketingExpenses INTEGER, sellingGeneralAndAdministrativeExpenses INTEGER, otherExpenses INTEGER, operatingExpenses INTEGER, costAndExpenses INTEGER, interestIncome INTEGER, interestExpense INTEGER, depreciationAndAmortization INTEGER, ebitda INTEGER, ebitdaratio DOUBLE, operatingIncome INTEGER, operatingIncomeRatio DOUBLE, totalOtherIncomeExpensesNet INTEGER, incomeBeforeTax INTEGER, incomeBeforeTaxRatio DOUBLE, incomeTaxExpense INTEGER, netIncome INTEGER, netIncomeRatio DOUBLE, eps DOUBLE, epsdiluted DOUBLE, weightedAverageShsOut INTEGER, weightedAverageShsOutDil INTEGER );
-CREATE TABLE IF NOT EXISTS balancesheet_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), cashAndCashEquivalents INTEGER, shortTermInvestments INTEGER, cashAndShortTermInvestments INTEGER, netReceivables INTEGER, inventory INTEGER, otherCurrentAssets INTEGER, totalCurrentAssets INTEGER, propertyPlantEquipmentNet INTEGER, goodwill INTEGER, intangibleAssets INTEGER, goodwillAndIntangibleAssets INTEGER, longTermInvestments INTEGER, taxAssets INTEGER, otherNonCurrentAssets INTEGER, totalNonCurrentAssets INTEGER, otherAssets INTEGER, totalAssets INTEGER, accountPayables INTEGER, shortTermDebt INTEGER, taxPayables INTEGER, deferredRevenue INTEGER, otherCurrentLiabilities INTEGER, totalCurrentLiabilities INTEGER, longTermDebt INTEGER, deferredRevenueNonCurrent INTEGER, deferredTaxLiabilitiesNonCurrent INTEGER, otherNonCurrentLiabilities INTEGER, totalNonCurrentLiabilities INTEGER, otherLiabilities INTEGER, capitalLeaseObligations INTEGER, totalLiabilities VARCHAR(20), preferredStock VARCHAR(20), commonStock VARCHAR(20), retainedEarnings VARCHAR(20), accumulatedOtherComprehensiveIncomeLoss VARCHAR(20), othertotalStockholdersEquity VARCHAR(20), totalStockholdersEquity VARCHAR(20), totalEquity VARCHAR(20), totalLiabilitiesAndStockholdersEquity VARCHAR(20), minorityInterest VARCHAR(20), totalLiabilitiesAndTotalEquity VARCHAR(20), totalInvestments VARCHAR(20), totalDebt VARCHAR(20), netDebt VARCHAR(20) ); 
-CREATE TABLE IF NOT EXISTS cashflow_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), netIncome INTEGER, depreciationAndAmortization INTEGER, deferredIncomeTax INTEGER, stockBasedCompensation INTEGER, changeInWorkingCapital INTEGER, accountsReceivables INTEGER, inventory INTEGER, accountsPayables INTEGER, otherWorkingCapital INTEGER, otherNonCashItems INTEGER, netCashProvidedByOperatingActivities INTEGER, investmentsInPropertyPlantAndEquipment INTEGER, acquisitionsNet INTEGER, purchasesOfInvestments INTEGER, salesMaturitiesOfInvestments INTEGER, otherInvestingActivites INTEGER, netCashUsedForInvestingActivites INTEGER, debtRepayment INTEGER, commonStockIssued INTEGER, commonStockRepurchased INTEGER, dividendsPaid INTEGER, otherFinancingActivites INTEGER, netCashUsedProvidedByFinancingActivities INTEGER, effectOfForexChangesOnCash INTEGER, netChangeInCash INTEGER, cashAtEndOfPeriod INTEGER, cashAtBeginningOfPeriod INTEGER, operatingCashFlow INTEGER, capitalExpenditure INTEGER, freeCashFlow INTEGER ); 
+{schema}
 The 'symbol' column in each table contains the companies names in capital letters.
 
 {request}
@@ -149,10 +214,11 @@ The 'symbol' column in each table contains the companies names in capital letter
 Generate suggestion:
 """
 
-PROMPT3 = PromptTemplate(input_variables=["request"], template=template3)
+PROMPT3 = PromptTemplate(input_variables=["request", "schema"], template=template3)
 
 # Suggestion Generation Chain
-sug_chain = (PROMPT3
+sug_chain = (with_schema
+             | PROMPT3
              | llm
              | StrOutputParser()       # to get output in a more usable format
              )
@@ -166,10 +232,7 @@ Response should not be more than 10 lines.
 If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
 SQLite database has following tables:
-CREATE TABLE IF NOT EXISTS stock_prices (date DATE, open DOUBLE, high DOUBLE, low DOUBLE, close DOUBLE, volume INT, symbol VARCHAR(20));
-CREATE TABLE IF NOT EXISTS income_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), revenue INTEGER, costOfRevenue INTEGER, grossProfit INTEGER, grossProfitRatio DOUBLE, researchAndDevelopmentExpenses INTEGER, generalAndAdministrativeExpenses INTEGER, sellingAndMarketingExpenses INTEGER, sellingGeneralAndAdministrativeExpenses INTEGER, otherExpenses INTEGER, operatingExpenses INTEGER, costAndExpenses INTEGER, interestIncome INTEGER, interestExpense INTEGER, depreciationAndAmortization INTEGER, ebitda INTEGER, ebitdaratio DOUBLE, operatingIncome INTEGER, operatingIncomeRatio DOUBLE, totalOtherIncomeExpensesNet INTEGER, incomeBeforeTax INTEGER, incomeBeforeTaxRatio DOUBLE, incomeTaxExpense INTEGER, netIncome INTEGER, netIncomeRatio DOUBLE, eps DOUBLE, epsdiluted DOUBLE, weightedAverageShsOut INTEGER, weightedAverageShsOutDil INTEGER );
-CREATE TABLE IF NOT EXISTS balancesheet_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), cashAndCashEquivalents INTEGER, shortTermInvestments INTEGER, cashAndShortTermInvestments INTEGER, netReceivables INTEGER, inventory INTEGER, otherCurrentAssets INTEGER, totalCurrentAssets INTEGER, propertyPlantEquipmentNet INTEGER, goodwill INTEGER, intangibleAssets INTEGER, goodwillAndIntangibleAssets INTEGER, longTermInvestments INTEGER, taxAssets INTEGER, otherNonCurrentAssets INTEGER, totalNonCurrentAssets INTEGER, otherAssets INTEGER, totalAssets INTEGER, accountPayables INTEGER, shortTermDebt INTEGER, taxPayables INTEGER, deferredRevenue INTEGER, otherCurrentLiabilities INTEGER, totalCurrentLiabilities INTEGER, longTermDebt INTEGER, deferredRevenueNonCurrent INTEGER, deferredTaxLiabilitiesNonCurrent INTEGER, otherNonCurrentLiabilities INTEGER, totalNonCurrentLiabilities INTEGER, otherLiabilities INTEGER, capitalLeaseObligations INTEGER, totalLiabilities VARCHAR(20), preferredStock VARCHAR(20), commonStock VARCHAR(20), retainedEarnings VARCHAR(20), accumulatedOtherComprehensiveIncomeLoss VARCHAR(20), othertotalStockholdersEquity VARCHAR(20), totalStockholdersEquity VARCHAR(20), totalEquity VARCHAR(20), totalLiabilitiesAndStockholdersEquity VARCHAR(20), minorityInterest VARCHAR(20), totalLiabilitiesAndTotalEquity VARCHAR(20), totalInvestments VARCHAR(20), totalDebt VARCHAR(20), netDebt VARCHAR(20) ); 
-CREATE TABLE IF NOT EXISTS cashflow_statement( date DATE, symbol VARCHAR(20), reportedCurrency VARCHAR(20), cik VARCHAR(20), fillingDate DATE, acceptedDate DATE, calendarYear INTEGER, period VARCHAR(20), netIncome INTEGER, depreciationAndAmortization INTEGER, deferredIncomeTax INTEGER, stockBasedCompensation INTEGER, changeInWorkingCapital INTEGER, accountsReceivables INTEGER, inventory INTEGER, accountsPayables INTEGER, otherWorkingCapital INTEGER, otherNonCashItems INTEGER, netCashProvidedByOperatingActivities INTEGER, investmentsInPropertyPlantAndEquipment INTEGER, acquisitionsNet INTEGER, purchasesOfInvestments INTEGER, salesMaturitiesOfInvestments INTEGER, otherInvestingActivites INTEGER, netCashUsedForInvestingActivites INTEGER, debtRepayment INTEGER, commonStockIssued INTEGER, commonStockRepurchased INTEGER, dividendsPaid INTEGER, otherFinancingActivites INTEGER, netCashUsedProvidedByFinancingActivities INTEGER, effectOfForexChangesOnCash INTEGER, netChangeInCash INTEGER, cashAtEndOfPeriod INTEGER, cashAtBeginningOfPeriod INTEGER, operatingCashFlow INTEGER, capitalExpenditure INTEGER, freeCashFlow INTEGER ); 
+{schema}
 The 'symbol' column in each table contains the companies names in capital letters.
 
 {request}
@@ -177,21 +240,263 @@ The 'symbol' column in each table contains the companies names in capital letter
 Generate response:
 """
 
-PROMPT4 = PromptTemplate(input_variables=["request"], template=template4)
+PROMPT4 = PromptTemplate(input_variables=["request", "schema"], template=template4)
 
 # General Response Chain
-gnrl_chain = (PROMPT4
+gnrl_chain = (with_schema
+              | PROMPT4
               | llm
               | StrOutputParser()       # to get output in a more usable format
               )
 
 
-# Club SQL + Code generation chains
-sql_code_chain = sql_chain | code_chain
+### Create Chain for Routing a request in a single call: classification, SQL query and analysis code
+# Build prompt
+template5 = """
+You are a SQLite and Python expert. Given the user request below, return its classification, and for requests that need data a SQLite query and the python code showing insights from it.
+
+Classification: `Need SQL` if the request requires some data to be fetched from the database tables, `Non SQL` if it does not require any data
+to be fetched but instead needs information on what type of data is present inside the database tables, `Other` if the request looks out of the context.
+
+For `Need SQL` requests only:
+SQL query: a syntactically correct SQLite query. Unless the user specifies a number of examples, query for at most 10 results using the LIMIT clause.
+Query only the columns needed to answer the question, wrap each column name in double quotes ("), and use only the tables and columns you can see below.
+Use date('now') if the question involves "today". Do not return any new columns nor perform aggregation on columns, further aggregations are done by the python code.
+{rollup_hint}
+Use only correct ticker symbols of current Nifty 50 constituents for filtering.
+Code: python code that shows insights related to the data returned by the SQL query. The rows of the SQL query will already be loaded in a pandas DataFrame
+named `df` when the code runs, use it directly: do not connect to the database or run the query again.
+{plot_hint}
+Tables or numerical values should be printed out explicitely using print statements along with their description.
+{cube_hint}
+Leave the code empty if you are not sure how to write it.
+
+The databse has following tables:
+{schema}
+The 'symbol' column in each table contains the companies names in capital letters.
+
+Request: {request}
+"""
+
+PROMPT5 = PromptTemplate(input_variables=["request", "schema"], template=template5,
+                         partial_variables={"rollup_hint": ROLLUP_HINT, "plot_hint": PLOT_HINT, "cube_hint": CUBE_HINT})
+
+
+class RoutedRequest(BaseModel):
+    """Classification of a user request, with the SQL query and analysis code of `Need SQL` requests."""
+    classification: Literal["Need SQL", "Non SQL", "Other"]
+    sql_query: Optional[str] = Field(default=None, description="SQLite query, only for `Need SQL` requests")
+    code: Optional[str] = Field(default=None, description="Python code only (no markdown fences), only for `Need SQL` requests")
+
+
+# Routing Chain, the structured output is kept as JSON text so it can be cached like the other chains
+route_chain = (with_schema
+               | PROMPT5
+               | llm.with_structured_output(RoutedRequest)
+               | RunnableLambda(lambda routed: routed.model_dump_json())
+               )
+
+
+### Cache the chain responses: repeated requests skip the LLM calls entirely.
+# The model name, the prompt template (with its shared instructions) and the schema retrieval settings are part of
+# each cache key, so editing a prompt starts a fresh cache.
+# Near-repeat matching (LLM_CACHE_SIMILARITY) only applies to the request-keyed chains, the code chain is keyed on the exact
+# request, SQL and result columns (not even whitespace or case normalised, the SQL string literals matter). Hits and misses are recorded on the stage of the request trace.
+def record_cache(hit):
+    record_value('cache', 'hit' if hit else 'miss')
+
+
+def cached(chain, name, prompt, semantic=False, exact=False):
+    partials = '\n'.join(f"{variable}={value}" for variable, value in sorted(prompt.partial_variables.items()))
+    return response_cache.wrap(chain, name, fingerprint=f"{llm.model_name}\n{schema_retriever.fingerprint}\n{prompt.template}\n{partials}",
+                               semantic=semantic, exact=exact, on_lookup=record_cache)
+
+clf_chain = cached(clf_chain, 'clf', PROMPT0, semantic=True)
+sql_chain = cached(sql_chain, 'sql', PROMPT1, semantic=True)
+code_chain = cached(code_chain, 'code', PROMPT2, exact=True)
+sug_chain = cached(sug_chain, 'sug', PROMPT3, semantic=True)
+gnrl_chain = cached(gnrl_chain, 'gnrl', PROMPT4, semantic=True)
+route_chain = cached(route_chain, 'route', PROMPT5, semantic=True)
+
+
+# Every LLM call is awaited (ainvoke / astream) and the blocking SQL and code execution is offloaded to `sql_executor`
+# and `repl_executor`, so one user's request never freezes the event loop for the other sessions.
+# Text shown to the user is passed to `emit` (an async callable taking the next piece of text) as soon as it is produced.
+# Each step runs in a tracing stage: its time, LLM tokens, cache lookups, SQL rows and errors go to the request trace.
+async def no_emit(text):
+    pass
+
+
+async def stream_chain(chain, inputs, emit=no_emit):
+    chunks = []
+    async for chunk in chain.astream(inputs):
+        chunks.append(chunk)
+        await emit(chunk)
+    return ''.join(chunks)
+
+
+async def run_sql(sql_query):
+    with stage('sql_execution') as record:
+        # Run in a copy of the context so the result cache hit or miss is recorded on this stage
+        context = contextvars.copy_context()
+        df = await asyncio.get_running_loop().run_in_executor(sql_executor, context.run, query_runner.run, sql_query,
+                                                              record_cache)
+        record['rows'] = len(df)
+    return df
+
+
+# The printed lines of the code are emitted while it runs, relayed from the executor thread through a queue
+async def run_code(code_response, df, emit=no_emit):
+    with stage('code_execution'):
+        return await _run_code(code_response, df, emit)
+
+
+async def _run_code(code_response, df, emit):
+    loop = asyncio.get_running_loop()
+    printed = asyncio.Queue()
+    job = loop.run_in_executor(repl_executor, execution_pool.run, code_response, {"df": df},
+                               lambda text: loop.call_soon_threadsafe(printed.put_nowait, text))
+    streamed = ''
+    while not (job.done() and printed.empty()):
+        next_text = asyncio.ensure_future(printed.get())
+        await asyncio.wait({next_text, job}, return_when=asyncio.FIRST_COMPLETED)
+        if next_text.done():
+            streamed += next_text.result()
+            await emit(next_text.result())
+        else:
+            next_text.cancel()
+    output, figures, error = job.result()
+    if error:
+        record_value('error', error)
+    record_value('figures', len(figures))
+    # What was not streamed: an exception raised by the code, a timeout
+    await emit(output[len(streamed):] if output.startswith(streamed) else f"\n{output}")
+    return output, figures
+
+
+def describe_frame(df):
+    columns = ', '.join(f"{column} ({dtype})" for column, dtype in df.dtypes.astype(str).items())
+    return f"DataFrame `df`: {len(df)} rows, columns: {columns}"
+
+
+# Answer a `Need SQL` request: generate the SQL query (unless given), run it, then generate the analysis code for the
+# resulting DataFrame (unless given) and execute it with `df` already defined. Returns (output, figures).
+# A refused or failing query goes back to the SQL chain with the reason, up to SQL_ATTEMPTS queries in total.
+async def answer_with_data(request, sql_query=None, code_response=None, emit=no_emit):
+    inputs = {"request": request}
+    for attempt in range(SQL_ATTEMPTS):
+        if not sql_query:
+            with stage('sql_generation', attempt=attempt + 1):
+                sql_query = await sql_chain.ainvoke(inputs)
+        sql_query = clean_sql(sql_query)
+        try:
+            df = await run_sql(sql_query)
+            break
+        except (QueryRejected, sqlite3.Error) as e:
+            if isinstance(e, QueryRejected):
+                error = f"The generated SQL query was rejected: {e}\nSQLQuery: {sql_query}"
+            else:
+                error = f"The generated SQL query failed: {e!r}\nSQLQuery: {sql_query}"
+            inputs = {"request": request, "hint": f"{error}\nWrite a different SQL query."}
+            # A routed code was written for the rejected query, regenerate it too
+            sql_query = code_response = None
+    else:
+        await emit(error)
+        return error, []
+    if not code_response:
+        ## Generate code for insights
+        with stage('code_generation'):
+            code_response = await code_chain.ainvoke(f"Request: {request}\nSQLQuery: {sql_query}\n{describe_frame(df)}")
+    ## Execute code
+    return await run_code(code_response, df, emit)
+
+
+async def out_of_context(emit=no_emit):
+    output = "The request is out of context."
+    await emit(output)
+    return output
+
+
+# Answer a request with the chains: classify it, then run the SQL -> code -> execution path or the general response chain
+async def answer_chained(request, emit=no_emit):
+    # Route the user request to necessary chain
+    with stage('classification'):
+        clf_label = await clf_chain.ainvoke({"request": request})
+        record_value('classification', clf_label.strip())
+
+    if "need sql" in clf_label.lower():
+        return await answer_with_data(request, emit=emit)
+    elif "non sql" in clf_label.lower():
+        with stage('general_response'):
+            output = await stream_chain(gnrl_chain, {"request": request}, emit)
+    else:
+        output = await out_of_context(emit)
+    return output, []
+
+
+# Answer a request from one routing call. Only the missing pieces are generated by the chains: the code for the
+# routed SQL query if the model left it empty, both if it returned no SQL query for a `Need SQL` request.
+async def answer_routed(request, routed, emit=no_emit):
+    if routed.classification == "Need SQL":
+        return await answer_with_data(request, routed.sql_query, routed.code if routed.sql_query else None, emit)
+    elif routed.classification == "Non SQL":
+        with stage('general_response'):
+            output = await stream_chain(gnrl_chain, {"request": request}, emit)
+    else:
+        output = await out_of_context(emit)
+    return output, []
+
+
+# Answer a request: (text output, [(name, PNG bytes)] of the figures drawn by the generated code)
+async def answer_request(request, emit=no_emit):
+    if ROUTER_MODE == 'single':
+        try:
+            with stage('routing'):
+                routed = RoutedRequest.model_validate_json(await route_chain.ainvoke({"request": request}))
+                record_value('classification', routed.classification)
+        except Exception as e:
+            # e.g. a malformed structured output, answer with the chains instead
+            print(f"Single-call routing failed ({e!r}), falling back to the chains.")
+        else:
+            return await answer_routed(request, routed, emit)
+    return await answer_chained(request, emit)
+
+
+async def suggest(request, emit=no_emit):
+    with stage('suggestions'):
+        return await stream_chain(sug_chain, {"request": request}, emit)
 
 
 ### Create UI using Chainlit
 import chainlit as cl
+from chainlit.server import app as server
+from fastapi.responses import PlainTextResponse
+
+
+# Prometheus-style metrics of the traced requests (stage latency histograms, tokens, cache hits, SQL rows, errors)
+@server.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics_text(), media_type="text/plain; version=0.0.4")
+
+# Chainlit serves its UI from a catch-all route registered before, move /metrics ahead of it
+server.router.routes.insert(0, server.router.routes.pop())
+
+
+# A chat message filled token by token, noting the time to its first token (from `started`, when the request came in)
+class StreamedMessage:
+
+    def __init__(self, header, started):
+        self.message = cl.Message(content=header)
+        self.started = started
+        self.ttft = None
+
+    async def write(self, text):
+        if not text:
+            return
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+        await self.message.stream_token(text)
+
 
 @cl.on_chat_start            # for actions to happen when the chat starts
 async def main():
@@ -205,43 +510,33 @@ async def main(message: cl.Message):
 
     # print(f"User Input: {message.content}")
 
-    # Remove any files from 'figures' directory
-    for filename in os.listdir('figures'):
-        file_path = os.path.join('figures', filename)
-        if os.path.isfile(file_path) and filename != '__init__.py':
-            os.remove(file_path)  # Remove file
-
-    # Route the user request to necessary chain
-    clf_label = clf_chain.invoke({"request": message.content})
-
-    if "need sql" in clf_label.lower():
-        ## Generate code for insights
-        code_response = sql_code_chain.invoke({"request": message.content})
-        # print(code_response)
-        ## Execute code
-        output = repl_tool.run(code_response)
-        # print(output)
-    elif "non sql" in clf_label.lower():
-        output = gnrl_chain.invoke({"request": message.content})
-    else:
-        output = "The request is out of context."
-
-    # Generate suggestions
-    suggest = sug_chain.invoke({"request": message.content})
-    
-    # If image is present inside 'figures' directory then Send the plot image to the chat
-    if len(os.listdir('figures')) > 1:
-        for imgfile in os.listdir('figures'): 
-            print(imgfile)
-            if os.path.isfile(os.path.join('figures', imgfile)) and imgfile != '__init__.py':
-                # Attach the image to the message and send response, image, and suggestions
-                image = cl.Image(path="./figures/"+imgfile, name="image1", size="large", display="inline")
-                await cl.Message(
-                    content=f"Response: \n{output}", 
-                    elements=[image]
-                    ).send()
-                await cl.Message(content=f"Further suggestions: \n{suggest}",).send()
-    else:
-        # Send response and suggestions
-        await cl.Message(content=f"Response: \n{output}",).send()
-        await cl.Message(content=f"Further suggestions: \n{suggest}",).send()
+    started = time.perf_counter()
+    trace = start_trace(message.content)
+
+    # Response and suggestions messages are shown right away (in this order) and filled as the tokens come in
+    response = StreamedMessage("Response: \n", started)
+    suggestions = StreamedMessage("Further suggestions: \n", started)
+    await response.message.send()
+    await suggestions.message.send()
+
+    try:
+        # Answer the request and generate suggestions concurrently (suggestions only depend on the request)
+        (output, figures), _ = await asyncio.gather(
+            answer_request(message.content, response.write),
+            suggest(message.content, suggestions.write),
+        )
+
+        # Figures come back from the sandbox as in-memory PNGs of this request only, attach them to the response
+        with stage('figure_upload', figures=len(figures)):
+            response.message.elements = [cl.Image(content=png, name=name, mime="image/png", size="large", display="inline")
+                                         for name, png in figures]
+            await response.message.update()
+            await suggestions.message.update()
+    except Exception as e:
+        record_value('error', repr(e))
+        raise
+    finally:
+        # Time to first token: the latency the user actually waits before seeing something
+        record_value('ttft_response', response.ttft)
+        record_value('ttft_suggestions', suggestions.ttft)
+        finish_trace(trace)
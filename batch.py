@@ -0,0 +1,144 @@
+### Headless batch mode: answer a file of questions through the app.py pipeline, without the Chainlit UI
+# Questions run concurrently (--concurrency), the LLM calls are rate limited client-side (--rpm) and retried with
+# exponential backoff by the OpenAI client; a question that still fails is retried as a whole (--retries).
+# Each answer is written to <out>/<number>/ (output.txt and the PNG figures), results.jsonl has one line per
+# question, summary.json the totals and the throughput in questions per minute, traces.jsonl the stage timings.
+# Usage:
+#     python batch.py questions.txt --out results --concurrency 8 --rpm 500
+#     questions.txt: one question per line (blank lines and lines starting with '#' are skipped),
+#     or a .jsonl file of {"id": ..., "question": ...}
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Answer a file of questions with the app.py pipeline")
+    parser.add_argument('questions', help="text file with one question per line, or a .jsonl file")
+    parser.add_argument('--out', default='results', help="results directory")
+    parser.add_argument('--concurrency', type=int, default=8, help="questions answered at the same time")
+    parser.add_argument('--rpm', type=float, default=None, help="LLM requests per minute (default: LLM_REQUESTS_PER_MINUTE)")
+    parser.add_argument('--retries', type=int, default=2, help="retries of a question whose pipeline raised")
+    parser.add_argument('--backoff', type=float, default=2.0, help="seconds before the first retry, doubled after each")
+    parser.add_argument('--suggestions', action='store_true', help="also generate the further suggestions")
+    return parser.parse_args()
+
+
+def read_questions(path):
+    """[(id, question)] of a text or .jsonl file."""
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    if path.endswith('.jsonl'):
+        records = [json.loads(line) for line in lines if line]
+        # The ids name the answer directories
+        return [(re.sub(r'[^\w.-]', '_', str(record.get('id', i + 1))), record['question']) for i, record in enumerate(records)]
+    questions = [line for line in lines if line and not line.startswith('#')]
+    return [(str(i + 1), question) for i, question in enumerate(questions)]
+
+
+def write_answer(directory, output, figures, suggestions=None):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'output.txt'), 'w') as f:
+        f.write(output)
+    if suggestions is not None:
+        with open(os.path.join(directory, 'suggestions.txt'), 'w') as f:
+            f.write(suggestions)
+    paths = []
+    for name, png in figures:
+        paths.append(os.path.join(directory, os.path.basename(name)))
+        with open(paths[-1], 'wb') as f:
+            f.write(png)
+    return paths
+
+
+async def answer(app, tracing, question_id, question, args):
+    """Answer one question (with retries), write its files and return its results.jsonl record."""
+    for attempt in range(args.retries + 1):
+        trace = tracing.start_trace(question)
+        try:
+            jobs = [app.answer_request(question)]
+            if args.suggestions:
+                jobs.append(app.suggest(question))
+            (output, figures), *suggestions = await asyncio.gather(*jobs)
+            error = None
+        except Exception as e:
+            error = repr(e)
+            trace.values['error'] = error
+        trace.values['attempt'] = attempt + 1
+        tracing.finish_trace(trace)
+        if error is None or attempt == args.retries:
+            break
+        # Exponential backoff with jitter, so that throttled questions do not all retry at the same moment
+        delay = args.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        print(f"[{question_id}] failed ({error}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    record = {'id': question_id, 'question': question, 'status': 'error' if error else 'ok', 'error': error,
+              'attempts': attempt + 1, 'seconds': trace.seconds,
+              'classification': next((stage['classification'] for stage in trace.stages if 'classification' in stage), None),
+              # e.g. a rejected SQL query or an exception of the generated code, the answer then says so
+              'stage_errors': {stage['stage']: stage['error'] for stage in trace.stages if 'error' in stage}}
+    if error is None:
+        directory = os.path.join(args.out, question_id)
+        record['figures'] = write_answer(directory, output, figures, suggestions[0] if suggestions else None)
+        record['output'] = os.path.join(directory, 'output.txt')
+    return record
+
+
+async def run_batch(app, tracing, questions, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    done = 0
+    with open(os.path.join(args.out, 'results.jsonl'), 'w') as results:
+
+        async def run_one(question_id, question):
+            nonlocal done
+            async with semaphore:
+                record = await answer(app, tracing, question_id, question, args)
+            # One line per question as soon as it is answered, a crashed run keeps what it finished
+            results.write(json.dumps(record) + '\n')
+            results.flush()
+            done += 1
+            print(f"[{done}/{len(questions)}] {record['status']} in {record['seconds']:.1f}s: {question}")
+            return record
+
+        # Each question runs in its own task, so it gets its own trace and tracing stages
+        return await asyncio.gather(*(run_one(question_id, question) for question_id, question in questions))
+
+
+def main():
+    args = parse_args()
+    questions = read_questions(args.questions)
+    os.makedirs(args.out, exist_ok=True)
+
+    # Settings read by app.py and tracing.py at import
+    if args.rpm is not None:
+        os.environ['LLM_REQUESTS_PER_MINUTE'] = str(args.rpm)
+    os.environ.setdefault('TRACE_LOG_PATH', os.path.join(args.out, 'traces.jsonl'))
+    import app
+    import tracing
+
+    started = time.perf_counter()
+    try:
+        records = asyncio.run(run_batch(app, tracing, questions, args))
+    finally:
+        app.execution_pool.close()
+    elapsed = time.perf_counter() - started
+
+    failed = [record for record in records if record['status'] != 'ok']
+    summary = {'questions': len(records), 'ok': len(records) - len(failed), 'failed': len(failed),
+               'seconds': round(elapsed, 1), 'questions_per_min': round(len(records) / elapsed * 60, 1) if records else 0,
+               'concurrency': args.concurrency, 'rpm': app.LLM_REQUESTS_PER_MINUTE or None}
+    with open(os.path.join(args.out, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f"\n{summary['ok']}/{summary['questions']} questions answered in {summary['seconds']}s "
+          f"({summary['questions_per_min']} questions/min), results in '{args.out}'")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
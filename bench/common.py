@@ -0,0 +1,69 @@
+### Shared helpers of the benchmark scenarios: a synthetic DB built by main.py, latency percentiles and the report
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+from bench.synthetic_data import generate
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def workdir_for(n_symbols, years):
+    return os.path.join(tempfile.gettempdir(), f"stocks-bench-{n_symbols}x{years}")
+
+
+def run_main(workdir, *args, verbose=False):
+    """Run main.py in `workdir` (reading ./data/*.pkl, writing ./stock_db.sqlite), return its wall time in seconds."""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'main.py'), *args], cwd=workdir, check=True,
+                   stdout=None if verbose else subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def prepare(n_symbols, years, workdir=None, rebuild=False):
+    """Directory holding the synthetic pickles and the DB, price cube and so on built from them (reused across runs)."""
+    workdir = workdir or workdir_for(n_symbols, years)
+    if rebuild or not os.path.exists(os.path.join(workdir, 'stock_db.sqlite')):
+        os.makedirs(workdir, exist_ok=True)
+        generate(n_symbols, years, out=os.path.join(workdir, 'data'))
+        print(f"Building the synthetic DB in '{workdir}' ({n_symbols} symbols x {years} years)...")
+        run_main(workdir)
+    return workdir
+
+
+def percentiles(seconds):
+    """{p50, p95, max, mean} in milliseconds."""
+    values = np.asarray(seconds, dtype=float) * 1000
+    if not len(values):
+        return {}
+    return {'p50_ms': round(float(np.percentile(values, 50)), 2), 'p95_ms': round(float(np.percentile(values, 95)), 2),
+            'max_ms': round(float(values.max()), 2), 'mean_ms': round(float(values.mean()), 2)}
+
+
+def scale_arguments(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--symbols', type=int, default=50)
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--workdir', default=None, help="directory of the synthetic data (default: a temp directory per scale)")
+    parser.add_argument('--rebuild', action='store_true', help="regenerate the data and rebuild the DB")
+    parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+    return parser
+
+
+def report(scenario, results, output=None):
+    """Print the results of a scenario (a dict, or a list of row dicts) and optionally save them as JSON."""
+    print(f"\n=== {scenario} ===")
+    for row in results if isinstance(results, list) else [results]:
+        print('  ' + ', '.join(f"{key}: {value}" for key, value in row.items()))
+    if output:
+        save(output, scenario, results)
+
+
+def save(output, scenario, results):
+    with open(output, 'w') as f:
+        json.dump({'scenario': scenario, 'time': time.time(), 'results': results}, f, indent=2)
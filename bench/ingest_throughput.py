@@ -0,0 +1,108 @@
+### Ingest benchmark: main.py on synthetic pickles, a full rebuild then an incremental refresh
+# Also checks that an incremental refresh gives the same DB as a full rebuild: the DB is rebuilt from the prices up
+# to a January day whose week started in December, refreshed with --incremental and compared table by table.
+# Usage:
+#     python -m bench.ingest_throughput --symbols 50 --years 10 [--workers 4] [--output ingest.json]
+import os
+import shutil
+import pickle
+import sqlite3
+from contextlib import closing
+from bench.common import percentiles, report, run_main, scale_arguments, workdir_for
+from bench.synthetic_data import generate
+from derived import period_starts
+from ingest import STATEMENTS, format_dates
+from schema import declared_schema
+
+
+def table_rows(db_path):
+    with closing(sqlite3.connect(db_path)) as conn:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+
+
+def year_end_cutoff(dates):
+    """Latest January trading day whose week started in December, so the rollups of a refresh from it span two years."""
+    dates = sorted(set(format_dates(dates)))
+    spanning = [date for date, week in zip(dates, period_starts(dates, 'W')) if date[5:7] == '01' and week[5:7] == '12']
+    if not spanning:
+        # Without such a week the check would not cover the rollups of a refresh across a year boundary
+        raise SystemExit(f"No week of {dates[0]}..{dates[-1]} spans New Year, use more --years for the incremental check.")
+    return spanning[-1]
+
+
+def table_differences(db_path, other_path):
+    """{table: rows found in only one of the two DBs}, for the tables that differ."""
+    differences = {}
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("ATTACH DATABASE ? AS other", (other_path,))
+        tables = [row[0] for row in conn.execute("SELECT name FROM main.sqlite_master "
+                                                 "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            columns = ', '.join(f'"{column}"' for column in declared_schema(conn, table))
+            query = "SELECT COUNT(*) FROM (SELECT {columns} FROM {a}.{table} EXCEPT SELECT {columns} FROM {b}.{table})"
+            rows = sum(conn.execute(query.format(columns=columns, a=a, b=b, table=table)).fetchone()[0]
+                       for a, b in (('main', 'other'), ('other', 'main')))
+            if rows:
+                differences[table] = rows
+    return differences
+
+
+def check_incremental(workdir, options):
+    """Rebuild from the prices up to a year-end cutoff, refresh with --incremental and compare with the full rebuild.
+
+    Returns the refresh time in seconds, raises SystemExit if the DBs differ.
+    """
+    prices_path = os.path.join(workdir, 'data', 'constituent_stock_prices.pkl')
+    db_path = os.path.join(workdir, 'stock_db.sqlite')
+    full_path = os.path.join(workdir, 'stock_db.full.sqlite')
+    shutil.copyfile(db_path, full_path)
+    with open(prices_path, 'rb') as f:
+        prices = pickle.load(f)
+    cutoff = year_end_cutoff(next(iter(prices.values())).index)
+    shutil.move(prices_path, prices_path + '.full')
+    try:
+        with open(prices_path, 'wb') as f:
+            pickle.dump({symbol: df[format_dates(df.index) <= cutoff] for symbol, df in prices.items()}, f)
+        run_main(workdir, *options)
+        shutil.move(prices_path + '.full', prices_path)
+        seconds = run_main(workdir, '--incremental', *options)
+    finally:
+        if os.path.exists(prices_path + '.full'):
+            shutil.move(prices_path + '.full', prices_path)
+    differences = table_differences(db_path, full_path)
+    os.remove(full_path)
+    if differences:
+        raise SystemExit(f"Incremental refresh from {cutoff} differs from the full rebuild (rows): {differences}")
+    print(f"Incremental refresh from {cutoff} matches the full rebuild.")
+    return seconds
+
+
+def main():
+    parser = scale_arguments("Time main.py on synthetic data: full rebuild and incremental refresh")
+    parser.add_argument('--workers', type=int, default=None, help="passed to main.py")
+    parser.add_argument('--repeat', type=int, default=1, help="full rebuilds to time")
+    args = parser.parse_args()
+
+    workdir = args.workdir or workdir_for(args.symbols, args.years)
+    generate(args.symbols, args.years, out=os.path.join(workdir, 'data'))
+    options = ['--workers', str(args.workers)] if args.workers else []
+    db_path = os.path.join(workdir, 'stock_db.sqlite')
+
+    full = [run_main(workdir, *options) for _ in range(args.repeat)]
+    rows = table_rows(db_path)
+    incremental = run_main(workdir, '--incremental', *options)
+    refresh = check_incremental(workdir, options)
+
+    price_rows = rows.get('stock_prices', 0)
+    statement_rows = sum(rows.get(statement, 0) for statement in STATEMENTS)
+    report('ingest', {
+        'symbols': args.symbols, 'years': args.years, 'price_rows': price_rows, 'statement_rows': statement_rows,
+        'full_s': round(min(full), 2), 'price_rows_per_s': int(price_rows / min(full)),
+        'incremental_noop_s': round(incremental, 2), 'incremental_refresh_s': round(refresh, 2), 'db_mb': round(os.path.getsize(db_path) / 2**20, 1),
+        **{f"full_{key}": value for key, value in percentiles(full).items() if args.repeat > 1},
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
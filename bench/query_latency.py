@@ -0,0 +1,51 @@
+### Query latency benchmark: the typical generated queries (layout.TYPICAL_QUERIES) through app.py's QueryRunner
+# Each query is timed uncached (result cache off) and cached, then all of them from concurrent threads for throughput.
+# Usage:
+#     python -m bench.query_latency --symbols 50 --years 10 [--repeat 20] [--threads 4] [--output queries.json]
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bench.common import percentiles, prepare, report, scale_arguments
+from layout import TYPICAL_QUERIES
+from query_runner import QueryRejected, QueryRunner
+
+
+def timed(runner, sql):
+    started = time.perf_counter()
+    try:
+        rows = len(runner.run(sql))
+    except QueryRejected as e:
+        rows = f"rejected: {e}"
+    return time.perf_counter() - started, rows
+
+
+def main():
+    parser = scale_arguments("Time the typical generated SQL queries on a synthetic DB")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    db_path = os.path.join(prepare(args.symbols, args.years, args.workdir, args.rebuild), 'stock_db.sqlite')
+
+    uncached = QueryRunner(db_path, pool_size=args.threads, cache_entries=0)
+    cached = QueryRunner(db_path, pool_size=args.threads)
+    results = []
+    for sql in TYPICAL_QUERIES:
+        runs = [timed(uncached, sql) for _ in range(args.repeat)]
+        timed(cached, sql)
+        hits = [timed(cached, sql)[0] for _ in range(args.repeat)]
+        results.append({'query': ' '.join(sql.split())[:70], 'rows': runs[0][1],
+                        **percentiles([seconds for seconds, _ in runs]), 'cached_p50_ms': percentiles(hits)['p50_ms']})
+
+    # Throughput: every query `repeat` times from `threads` threads sharing the pooled connections
+    jobs = TYPICAL_QUERIES * args.repeat
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as executor:
+        latencies = [seconds for seconds, _ in executor.map(lambda sql: timed(uncached, sql), jobs)]
+    elapsed = time.perf_counter() - started
+    results.append({'query': f"all, {args.threads} threads", 'rows': '-', **percentiles(latencies),
+                    'queries_per_s': round(len(jobs) / elapsed, 1)})
+    report('query latency', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
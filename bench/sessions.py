@@ -0,0 +1,110 @@
+### Concurrent-session benchmark: the app.py pipeline end to end with the stub LLM, at several concurrency levels
+# Each session sends its requests one after the other (answer + suggestions, like on_message), the sessions run
+# concurrently. Reports requests per minute, latency and time to first token, and the p95 of every traced stage.
+# The LLM and SQL result caches are off unless --warm, so every request goes through the whole pipeline.
+# Usage:
+#     python -m bench.sessions --symbols 50 --years 10 --sessions 1,4,16 --requests 32 [--llm-latency 0.5] [--warm]
+import os
+import time
+import asyncio
+from collections import defaultdict
+from bench.common import percentiles, prepare, report, save, scale_arguments
+
+
+QUESTIONS = ["Show me the daily close and volume of {symbol} for the last year.",
+             "What was the revenue of {symbol} in the past 3 years?",
+             "Plot the monthly close of {symbol} since 2015.",
+             "How deep is the drawdown of {symbol} and how volatile is it?",
+             "What is the valuation (PE and PB) of {symbol} this year?",
+             "What data is stored in the database?",
+             "Tell me a joke."]
+
+
+def requests_for(count):
+    from bench.synthetic_data import NIFTY_50
+    return [QUESTIONS[i % len(QUESTIONS)].format(symbol=NIFTY_50[(i // len(QUESTIONS)) % len(NIFTY_50)])
+            for i in range(count)]
+
+
+async def one_request(app, tracing, request):
+    """The work of on_message for one request, without the UI: returns its finished trace."""
+    trace = tracing.start_trace(request)
+
+    def first_token(message):
+        async def emit(text):
+            if text:
+                trace.values.setdefault(f"ttft_{message}", trace.elapsed())
+        return emit
+
+    try:
+        await asyncio.gather(app.answer_request(request, first_token('response')),
+                             app.suggest(request, first_token('suggestions')))
+    except Exception as e:
+        trace.values['error'] = repr(e)
+    tracing.finish_trace(trace)
+    return trace
+
+
+async def run_level(app, tracing, sessions, requests):
+    async def session(own):
+        return [await one_request(app, tracing, request) for request in own]
+
+    started = time.perf_counter()
+    traces = sum(await asyncio.gather(*(session(requests[i::sessions]) for i in range(sessions))), [])
+    elapsed = time.perf_counter() - started
+
+    stages = defaultdict(list)
+    for trace in traces:
+        for record in trace.stages:
+            stages[record['stage']].append(record['seconds'])
+    summary = {'sessions': sessions, 'requests': len(traces), 'errors': sum('error' in trace.values for trace in traces),
+               'requests_per_min': round(len(traces) / elapsed * 60, 1),
+               **{f"latency_{key}": value for key, value in percentiles([trace.seconds for trace in traces]).items()
+                  if key in ('p50_ms', 'p95_ms')},
+               **{f"ttft_{key}": value for key, value in percentiles([trace.values.get('ttft_response', trace.seconds)
+                                                                      for trace in traces]).items()
+                  if key in ('p50_ms', 'p95_ms')}}
+    breakdown = {'sessions': sessions, **{f"{stage}_p95_ms": percentiles(seconds)['p95_ms']
+                                          for stage, seconds in sorted(stages.items())}}
+    return summary, breakdown
+
+
+def main():
+    parser = scale_arguments("Concurrent sessions through the app.py pipeline with a stub LLM")
+    parser.add_argument('--sessions', default='1,4,16', help="comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=32, help="requests per concurrency level")
+    parser.add_argument('--llm-latency', type=float, default=None, help="seconds before the first token of each LLM call")
+    parser.add_argument('--warm', action='store_true', help="keep the LLM and SQL result caches on")
+    args = parser.parse_args()
+
+    workdir = prepare(args.symbols, args.years, args.workdir, args.rebuild)
+    # app.py reads its DB, price cube and caches from the working directory
+    os.chdir(workdir)
+    os.environ.setdefault('LLM_CACHE_PATH', 'bench_llm_cache.sqlite')
+    os.environ.setdefault('TRACE_LOG_PATH', 'bench_traces.jsonl')
+    if not args.warm:
+        os.environ.update(LLM_CACHE_TTL='0', SQL_RESULT_CACHE_ENTRIES='0')
+    if args.llm_latency is not None:
+        os.environ['STUB_LLM_LATENCY'] = str(args.llm_latency)
+
+    from bench import stub_llm
+    stub_llm.install()
+    import app
+    import tracing
+
+    summaries, breakdowns = [], []
+    try:
+        for sessions in map(int, args.sessions.split(',')):
+            summary, breakdown = asyncio.run(run_level(app, tracing, sessions, requests_for(args.requests)))
+            summaries.append(summary)
+            breakdowns.append(breakdown)
+    finally:
+        app.execution_pool.close()
+    report('concurrent sessions', summaries)
+    report('stage p95 by concurrency', breakdowns)
+    if args.output:
+        save(args.output, 'concurrent sessions', [{**summary, **breakdown} for summary, breakdown in zip(summaries, breakdowns)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+### Local, deterministic stand-in for ChatOpenAI (and for the sentence embedding model) used by the benchmarks
+# The answer is picked from the prompt template and the request: a classification, a SQL query on the tables built by
+# main.py, analysis code that prints and plots `df`, suggestions or a general response. Responses are streamed word by
+# word after a simulated network latency, and report a token usage of about 4 characters per token, so the timings,
+# the token counts and the caches of app.py behave as with the real model, without a key or a network.
+# Usage (before importing app.py):
+#     from bench import stub_llm
+#     stub_llm.install()                  # app.py's ChatOpenAI(...) is then a StubChatModel
+#     STUB_LLM_LATENCY=0.5 STUB_LLM_TOKEN_DELAY=0.01 python -m bench.sessions ...
+import os
+import re
+import json
+import time
+import zlib
+import asyncio
+import numpy as np
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from bench.synthetic_data import NIFTY_50
+
+
+# Settings, overridable through environment variables: seconds before the first token, then between two tokens
+LATENCY = float(os.environ.get('STUB_LLM_LATENCY', 0.3))
+TOKEN_DELAY = float(os.environ.get('STUB_LLM_TOKEN_DELAY', 0.005))
+
+# Dimension of the hashed bag-of-words embeddings of HashingEncoder
+EMBEDDING_DIMENSION = 256
+
+
+def request_of(prompt):
+    """The user request in a prompt: the last 'Request: ...' line, else the whole prompt."""
+    found = re.findall(r'^Request: (.+)$', prompt, flags=re.MULTILINE)
+    return found[-1] if found else prompt
+
+
+def symbol_of(request):
+    words = set(re.findall(r'[A-Za-z&-]+', request.upper()))
+    return next((symbol for symbol in NIFTY_50 if symbol in words), 'RELIANCE')
+
+
+def classify(request):
+    text = request.lower()
+    if any(word in text for word in ('weather', 'joke', 'recipe', 'football')):
+        return 'Other'
+    if any(word in text for word in ('which tables', 'what data', 'what kind of data', 'columns')):
+        return 'Non SQL'
+    return 'Need SQL'
+
+
+def sql_for(request):
+    symbol, text = symbol_of(request), request.lower()
+    if 'revenue' in text or 'income' in text:
+        return f'''SELECT "calendarYear", "revenue", "netIncome" FROM income_statement WHERE "symbol" = '{symbol}' ORDER BY "calendarYear" DESC LIMIT 10'''
+    if 'monthly' in text or 'since' in text:
+        return f'''SELECT "period_start", "close" FROM prices_monthly WHERE "symbol" = '{symbol}' ORDER BY "period_start"'''
+    if 'valuation' in text or ' pe ' in f" {text} ":
+        return f'''SELECT "date", "pe", "pb" FROM valuation WHERE "symbol" = '{symbol}' ORDER BY "date" DESC LIMIT 250'''
+    if 'drawdown' in text or 'volatility' in text:
+        return f'''SELECT "date", "drawdown", "volatility_20" FROM price_metrics WHERE "symbol" = '{symbol}' ORDER BY "date" DESC LIMIT 250'''
+    return f'''SELECT "date", "close", "volume" FROM stock_prices WHERE "symbol" = '{symbol}' ORDER BY "date" DESC LIMIT 250'''
+
+
+CODE = '''import matplotlib.pyplot as plt
+print("Summary of the returned rows:")
+print(df.describe())
+df.plot(x=df.columns[0], y=df.columns[1], figsize=(10, 5))
+plt.title("Returned rows")'''
+
+SUGGESTIONS = """1. Compare the monthly close of RELIANCE and TCS since 2015.
+2. Show the revenue of IT companies in the past 3 years.
+3. Which stocks have the deepest drawdown today?"""
+
+GENERAL = ("The database holds the daily prices of the Nifty 50 constituents (stock_prices), their income statement, "
+           "balance sheet and cash flow statement, and tables derived from them: price_metrics, valuation and weekly, "
+           "monthly and yearly price bars.")
+
+
+def respond(prompt, structured=False):
+    """The canned answer to one prompt of app.py."""
+    request = request_of(prompt)
+    if structured:
+        routed = {'classification': classify(request), 'sql_query': None, 'code': None}
+        if routed['classification'] == 'Need SQL':
+            routed.update(sql_query=sql_for(request), code=CODE)
+        return json.dumps(routed)
+    if 'classify it as either' in prompt:
+        return classify(request)
+    if 'You are a SQLite expert' in prompt:
+        return f"SQLQuery: {sql_for(request)}"
+    if 'generate python code' in prompt:
+        return CODE
+    if 'Generate suggestion:' in prompt:
+        return SUGGESTIONS
+    if 'Generate response:' in prompt:
+        return GENERAL
+    return "I don't know."
+
+
+def usage(prompt, text):
+    tokens_in, tokens_out = len(prompt) // 4 + 1, len(text) // 4 + 1
+    return {'input_tokens': tokens_in, 'output_tokens': tokens_out, 'total_tokens': tokens_in + tokens_out}
+
+
+def pieces(text):
+    # Words with their trailing whitespace, so that the joined chunks are the text again
+    return re.findall(r'\S+\s*|\s+', text)
+
+
+class StubChatModel(BaseChatModel):
+    """Accepts the ChatOpenAI arguments used by app.py, answers with `respond()`."""
+
+    model_name: str = 'stub'
+    temperature: float = 0
+    stream_usage: bool = True
+    latency: float = LATENCY
+    token_delay: float = TOKEN_DELAY
+
+    @property
+    def _llm_type(self):
+        return 'stub'
+
+    def _prompt(self, messages):
+        return '\n'.join(str(message.content) for message in messages)
+
+    def _generate(self, messages, stop=None, run_manager=None, structured=False, **kwargs):
+        prompt = self._prompt(messages)
+        text = respond(prompt, structured)
+        time.sleep(self.latency + self.token_delay * len(pieces(text)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage(prompt, text)))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, structured=False, **kwargs):
+        prompt = self._prompt(messages)
+        text = respond(prompt, structured)
+        await asyncio.sleep(self.latency)
+        for piece in pieces(text):
+            await asyncio.sleep(self.token_delay)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+        # Like OpenAI with stream_usage, the usage comes in a last empty chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=usage(prompt, text)))
+
+    def with_structured_output(self, schema, **kwargs):
+        return self.bind(structured=True) | RunnableLambda(lambda message: schema.model_validate_json(message.content))
+
+
+class HashingEncoder:
+    """Offline stand-in for the SentenceTransformer of schema_retrieval.py: a hashed bag of words, unit length."""
+
+    def encode(self, texts, normalize_embeddings=True):
+        vectors = np.zeros((len(texts), EMBEDDING_DIMENSION), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r'[a-z0-9]+', text.lower()):
+                vectors[i, zlib.crc32(word.encode()) % EMBEDDING_DIMENSION] += 1
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+
+def install(embeddings=True):
+    """Make `from langchain_openai import ChatOpenAI` return StubChatModel, and the embedding model a HashingEncoder."""
+    import langchain_openai
+    langchain_openai.ChatOpenAI = StubChatModel
+    os.environ.setdefault('OPENAI_KEY', 'stub')
+    if embeddings:
+        import schema_retrieval
+        schema_retrieval.load_encoder = lambda model_name=None: HashingEncoder()
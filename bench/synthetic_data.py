@@ -0,0 +1,111 @@
+### Synthetic market data in the shape of the real pickles read by main.py, at any scale
+# constituent_stock_prices.pkl: {'RELIANCE.NS': daily OHLCV DataFrame indexed by 'Date' (Asia/Kolkata), ...}
+# constituent_stock_fundamentals.pkl: {'RELIANCE.NS': {'income_statement': [record, ...], 'balancesheet_statement': ...,
+#                                                      'cashflow_statement': ...}, ...} with one FY filing per year
+# Prices are a seeded random walk, so the same arguments always produce the same data.
+# Usage:
+#     python -m bench.synthetic_data --symbols 50 --years 10 --out data
+import os
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# Tickers of the Nifty 50 constituents, the first ones used by the prompts and the typical queries of layout.py.
+# More symbols than this are named SYM050, SYM051, ...
+NIFTY_50 = ['RELIANCE', 'TCS', 'INFY', 'WIPRO', 'HDFCBANK', 'ICICIBANK', 'HINDUNILVR', 'ITC', 'SBIN', 'BHARTIARTL',
+            'KOTAKBANK', 'LT', 'AXISBANK', 'ASIANPAINT', 'MARUTI', 'HCLTECH', 'SUNPHARMA', 'TITAN', 'ULTRACEMCO', 'BAJFINANCE',
+            'NESTLEIND', 'HINDALCO', 'POWERGRID', 'NTPC', 'TECHM', 'M&M', 'TATAMOTORS', 'TATASTEEL', 'JSWSTEEL', 'ADANIENT',
+            'ADANIPORTS', 'ONGC', 'COALINDIA', 'GRASIM', 'BAJAJFINSV', 'DRREDDY', 'CIPLA', 'BRITANNIA', 'EICHERMOT',
+            'HEROMOTOCO', 'DIVISLAB', 'APOLLOHOSP', 'BPCL', 'INDUSINDBK', 'HDFCLIFE', 'SBILIFE', 'TATACONSUM', 'UPL',
+            'BAJAJ-AUTO', 'LTIM']
+
+# Statement line items (FMP field names) beyond the common ones, each a random amount in INR
+STATEMENT_ITEMS = {
+    'income_statement': ['revenue', 'costOfRevenue', 'grossProfit', 'researchAndDevelopmentExpenses',
+                         'sellingGeneralAndAdministrativeExpenses', 'operatingExpenses', 'interestExpense', 'ebitda',
+                         'depreciationAndAmortization', 'operatingIncome', 'incomeBeforeTax', 'incomeTaxExpense', 'netIncome',
+                         'weightedAverageShsOut', 'weightedAverageShsOutDil'],
+    'balancesheet_statement': ['cashAndCashEquivalents', 'shortTermInvestments', 'netReceivables', 'inventory',
+                               'totalCurrentAssets', 'propertyPlantEquipmentNet', 'goodwill', 'totalAssets', 'accountPayables',
+                               'shortTermDebt', 'totalCurrentLiabilities', 'longTermDebt', 'totalLiabilities', 'commonStock',
+                               'retainedEarnings', 'totalStockholdersEquity', 'totalEquity', 'totalDebt', 'netDebt'],
+    'cashflow_statement': ['netIncome', 'depreciationAndAmortization', 'stockBasedCompensation', 'changeInWorkingCapital',
+                           'operatingCashFlow', 'capitalExpenditure', 'acquisitionsNet', 'dividendsPaid',
+                           'netCashUsedForInvestingActivites', 'netChangeInCash', 'freeCashFlow'],
+}
+
+
+def symbols(n):
+    return NIFTY_50[:n] + [f"SYM{i:03d}" for i in range(len(NIFTY_50), n)]
+
+
+def price_frame(rng, dates):
+    """Daily OHLCV bars of one symbol as returned by yfinance: a geometric random walk around a random start price."""
+    close = rng.uniform(100, 5000) * np.exp(np.cumsum(rng.normal(0.0003, 0.018, len(dates))))
+    open_ = close * np.exp(rng.normal(0, 0.006, len(dates)))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.008, len(dates))))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.008, len(dates))))
+    return pd.DataFrame({'Open': open_, 'High': high, 'Low': low, 'Close': close,
+                         'Volume': rng.integers(100_000, 20_000_000, len(dates)),
+                         'Dividends': 0.0, 'Stock Splits': 0.0}, index=dates)
+
+
+def statements(rng, symbol, years, last_year):
+    """{statement: [FY record, ...]} of one symbol, newest first like the FMP API, with a few missing values."""
+    scale = rng.uniform(1e10, 1e12)
+    raw = {}
+    for statement, items in STATEMENT_ITEMS.items():
+        records = []
+        for year in range(last_year, last_year - years, -1):
+            record = {'date': f"{year}-03-31", 'symbol': f"{symbol}.NS", 'reportedCurrency': 'INR', 'cik': None,
+                      'fillingDate': f"{year}-05-10", 'acceptedDate': f"{year}-05-10 18:30:00",
+                      'calendarYear': str(year), 'period': 'FY'}
+            for item in items:
+                record[item] = int(scale * rng.uniform(0.05, 1.5)) if rng.random() > 0.03 else None
+            if statement == 'income_statement':
+                record['weightedAverageShsOut'] = int(scale / rng.uniform(500, 5000))
+                record['weightedAverageShsOutDil'] = record['weightedAverageShsOut']
+                record['eps'] = (record['netIncome'] or 0) / record['weightedAverageShsOut']
+                record['epsdiluted'] = record['eps']
+                record['grossProfitRatio'] = rng.uniform(0.1, 0.6)
+            record['link'] = f"https://www.bseindia.com/{symbol}/{year}.pdf"
+            record['finalLink'] = record['link']
+            records.append(record)
+        raw[statement] = records
+    return raw
+
+
+def generate(n_symbols=50, years=10, end='2024-06-28', out='data', seed=0):
+    """Write both pickles into `out`, return the number of price rows and statement records."""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end=end, periods=252 * years, name='Date', tz='Asia/Kolkata')
+    last_year = pd.Timestamp(end).year
+    prices, fundamentals = {}, {}
+    for symbol in symbols(n_symbols):
+        prices[f"{symbol}.NS"] = price_frame(rng, dates)
+        fundamentals[f"{symbol}.NS"] = statements(rng, symbol, years, last_year)
+
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(out, 'constituent_stock_prices.pkl'), 'wb') as f:
+        pickle.dump(prices, f)
+    with open(os.path.join(out, 'constituent_stock_fundamentals.pkl'), 'wb') as f:
+        pickle.dump(fundamentals, f)
+    return len(dates) * n_symbols, years * n_symbols * len(STATEMENT_ITEMS)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write synthetic constituent_stock_*.pkl files for main.py")
+    parser.add_argument('--symbols', type=int, default=50)
+    parser.add_argument('--years', type=int, default=10, help="years of trading days (252 per year) and of FY filings")
+    parser.add_argument('--end', default='2024-06-28', help="last trading day")
+    parser.add_argument('--out', default='data', help="directory of the pickles")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    price_rows, records = generate(args.symbols, args.years, args.end, args.out, args.seed)
+    print(f"{price_rows} price rows and {records} statement records written to '{args.out}'")
@@ -0,0 +1,70 @@
+### Memory-mapped price cube: dense (symbol x trading day x OHLCV) array of 'stock_prices', written by main.py
+# Usage in analysis code:
+#     cube = PriceCube()
+#     close = cube.view('close', start='2019-06-01')     # (symbol x trading day) view on the memory map, no copy
+#     cube.symbols, cube.dates_between(start='2019-06-01')
+import json
+import os
+import numpy as np
+
+
+CUBE_PATH = 'price_cube.npy'
+INDEX_PATH = 'price_cube_index.json'
+FIELDS = ['open', 'high', 'low', 'close', 'volume']
+
+
+def build_price_cube(conn, cube_path=CUBE_PATH, index_path=INDEX_PATH):
+    """Write 'stock_prices' as a float64 cube (NaN where a symbol has no bar) plus the symbol/date index sidecar.
+
+    The cube is filled one symbol at a time, then both files are swapped in atomically so readers never see a partial cube.
+    """
+    symbols = [row[0] for row in conn.execute("SELECT DISTINCT symbol FROM stock_prices ORDER BY symbol")]
+    dates = [row[0] for row in conn.execute("SELECT DISTINCT date FROM stock_prices ORDER BY date")]
+    day_index = np.array(dates, dtype='datetime64[D]')
+
+    cube = np.lib.format.open_memmap(cube_path + '.tmp', mode='w+', dtype=np.float64,
+                                     shape=(len(symbols), len(dates), len(FIELDS)))
+    cube[:] = np.nan
+    query = f"SELECT date, {', '.join(FIELDS)} FROM stock_prices WHERE symbol = ? ORDER BY date"
+    for i, symbol in enumerate(symbols):
+        rows = conn.execute(query, (symbol,)).fetchall()
+        days = np.array([row[0] for row in rows], dtype='datetime64[D]')
+        cube[i, np.searchsorted(day_index, days)] = np.array([row[1:] for row in rows], dtype=np.float64)
+    cube.flush()
+    del cube
+
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'symbols': symbols, 'dates': dates, 'fields': FIELDS}, f)
+    os.replace(cube_path + '.tmp', cube_path)
+    os.replace(index_path + '.tmp', index_path)
+    return len(symbols), len(dates)
+
+
+class PriceCube:
+    """Read-only access to the price cube, every slice returned is a view on the memory map."""
+
+    def __init__(self, cube_path=CUBE_PATH, index_path=INDEX_PATH):
+        self.data = np.load(cube_path, mmap_mode='r')
+        with open(index_path) as f:
+            index = json.load(f)
+        self.symbols = index['symbols']
+        self.dates = np.array(index['dates'], dtype='datetime64[D]')
+        self.fields = index['fields']
+        self._symbol_pos = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def day_slice(self, start=None, end=None):
+        """Slice of trading days with start <= date <= end ('yyyy-mm-dd' strings, None for open ended)."""
+        lo = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 'D'), side='left')
+        hi = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, 'D'), side='right')
+        return slice(lo, hi)
+
+    def dates_between(self, start=None, end=None):
+        return self.dates[self.day_slice(start, end)]
+
+    def view(self, field, symbol=None, start=None, end=None):
+        """(symbol x trading day) array of `field`, or the 1-D series of one `symbol`."""
+        days = self.day_slice(start, end)
+        values = self.data[:, days, self.fields.index(field)]
+        if symbol is not None:
+            return values[self._symbol_pos[symbol]]
+        return values
@@ -0,0 +1,234 @@
+### Derived tables computed at ingest time, so common analytics are indexed lookups instead of recomputations
+import numpy as np
+import pandas as pd
+from ingest import PRICE_KEY, bulk_load, insert_frame
+from schema import create_table
+
+
+# Trading days in a year, used to annualise volatility and as the 52-week window
+TRADING_DAYS = 252
+
+# Windows (in trading days) of the moving averages and of the rolling volatility
+MOVING_AVERAGES = (20, 50, 200)
+VOLATILITY_WINDOW = 20
+
+# Symbols read and computed together in one grouped pass
+SYMBOLS_PER_BATCH = 50
+
+
+#########################  Price metrics  #########################
+
+PRICE_METRICS_SCHEMA = {
+    'date': 'DATE',
+    'symbol': 'VARCHAR(20)',
+    'daily_return': 'DOUBLE',
+    **{f'ma_{window}': 'DOUBLE' for window in MOVING_AVERAGES},
+    f'volatility_{VOLATILITY_WINDOW}': 'DOUBLE',
+    'drawdown': 'DOUBLE',
+    'high_52w': 'DOUBLE',
+    'low_52w': 'DOUBLE',
+}
+
+
+def symbol_batches(conn, size=SYMBOLS_PER_BATCH):
+    symbols = [row[0] for row in conn.execute("SELECT DISTINCT symbol FROM stock_prices ORDER BY symbol")]
+    for start in range(0, len(symbols), size):
+        yield symbols[start:start + size]
+
+
+def read_prices(conn, symbols, columns=('high', 'low', 'close'), start=''):
+    """Daily prices of `symbols` on/after `start`, sorted by symbol and date (a range read on the clustered key)."""
+    query = f'''SELECT symbol, date, {', '.join(columns)} FROM stock_prices
+                WHERE symbol IN ({', '.join('?' * len(symbols))}) AND date >= ? ORDER BY symbol, date'''
+    return pd.read_sql_query(query, conn, params=[*symbols, start])
+
+
+def _rolling(grouped, window, how, min_periods=None):
+    # groupby().rolling() puts the symbol in front of the original index, drop it to align with the frame again
+    rolled = getattr(grouped.rolling(window, min_periods=min_periods or window), how)()
+    return rolled.droplevel(0)
+
+
+def compute_price_metrics(prices):
+    """Daily return, moving averages, annualised volatility, drawdown from the running high and 52-week high/low per symbol."""
+    metrics = prices[['date', 'symbol']].copy()
+    by_symbol = prices.groupby('symbol', sort=False)
+    metrics['daily_return'] = prices['close'] / by_symbol['close'].shift() - 1
+    for window in MOVING_AVERAGES:
+        metrics[f'ma_{window}'] = _rolling(by_symbol['close'], window, 'mean')
+    returns = metrics.groupby(prices['symbol'], sort=False)['daily_return']
+    metrics[f'volatility_{VOLATILITY_WINDOW}'] = _rolling(returns, VOLATILITY_WINDOW, 'std') * np.sqrt(TRADING_DAYS)
+    metrics['drawdown'] = prices['close'] / by_symbol['close'].cummax() - 1
+    metrics['high_52w'] = _rolling(by_symbol['high'], TRADING_DAYS, 'max', min_periods=1)
+    metrics['low_52w'] = _rolling(by_symbol['low'], TRADING_DAYS, 'min', min_periods=1)
+    return metrics
+
+
+def build_price_metrics(conn, since=None):
+    """Compute 'price_metrics' from 'stock_prices' in batches of symbols and upsert it.
+
+    Windows need the full history, so every symbol is recomputed, but with `since` ({symbol: 'yyyy-mm-dd'},
+    the price high-water marks before the load) only the rows on/after each symbol's mark are written.
+    """
+    since = since or {}
+    create_table(conn, 'price_metrics', PRICE_METRICS_SCHEMA, PRICE_KEY)
+    rows = 0
+    for symbols in symbol_batches(conn):
+        metrics = compute_price_metrics(read_prices(conn, symbols))
+        metrics = metrics[metrics['date'] >= metrics['symbol'].map(since).fillna('')]
+        with bulk_load(conn):
+            rows += insert_frame(conn, 'price_metrics', metrics, key=PRICE_KEY)
+    return rows
+
+
+#########################  Point-in-time valuation  #########################
+
+VALUATION_SCHEMA = {
+    'date': 'DATE',
+    'symbol': 'VARCHAR(20)',
+    'close': 'DOUBLE',
+    'accepted_date': 'DATE',
+    'market_cap': 'DOUBLE',
+    'pe': 'DOUBLE',
+    'pb': 'DOUBLE',
+    'ev_ebitda': 'DOUBLE',
+    'fcf_yield': 'DOUBLE',
+}
+
+# Statement columns used by the ratios, (table, only annual filings?, columns). Flows (earnings, EBITDA, FCF)
+# come from the annual ('FY') filings, the balance sheet from the latest filing of any period.
+VALUATION_INPUTS = [
+    ('income_statement', True, ['epsdiluted', 'weightedAverageShsOutDil', 'ebitda']),
+    ('balancesheet_statement', False, ['totalStockholdersEquity', 'netDebt']),
+    ('cashflow_statement', True, ['freeCashFlow']),
+]
+
+
+def read_filings(conn, table, annual, columns, symbols):
+    """Filings of `symbols` with the day they became public ('acceptedDate') as a datetime, sorted by it."""
+    query = f'''SELECT symbol, acceptedDate, {', '.join(columns)} FROM {table}
+                WHERE symbol IN ({', '.join('?' * len(symbols))}) {"AND period = 'FY'" if annual else ''}'''
+    filings = pd.read_sql_query(query, conn, params=list(symbols))
+    filings['acceptedDate'] = pd.to_datetime(filings['acceptedDate'])
+    return filings.dropna(subset=['acceptedDate']).sort_values('acceptedDate', kind='stable')
+
+
+def _ratio(numerator, denominator):
+    # Ratios on a zero or negative base (losses, negative equity/EBITDA) are not meaningful, leave them NULL
+    return (numerator / denominator.where(denominator > 0)).astype('float64')
+
+
+def compute_valuation(prices, filings):
+    """As-of join of each trading day with the latest filing accepted before it, then the valuation ratios.
+
+    'acceptedDate' is stored as a day, and a filing accepted during or after a session is not known at that day's
+    close, so a filing is only used from the next trading day (strictly earlier acceptance, no exact matches).
+    """
+    daily = prices[['symbol', 'date', 'close']].copy()
+    daily['day'] = pd.to_datetime(daily['date'])
+    daily = daily.sort_values('day', kind='stable')
+    daily['accepted_date'] = pd.NaT
+    for stmt_df in filings:
+        daily = pd.merge_asof(daily, stmt_df, left_on='day', right_on='acceptedDate', by='symbol', direction='backward',
+                              allow_exact_matches=False)
+        daily['accepted_date'] = daily[['accepted_date', 'acceptedDate']].max(axis=1)
+        daily = daily.drop(columns='acceptedDate')
+
+    market_cap = daily['close'] * daily['weightedAverageShsOutDil']
+    valuation = daily[['date', 'symbol', 'close']].copy()
+    valuation['accepted_date'] = daily['accepted_date'].dt.strftime('%Y-%m-%d')
+    valuation['market_cap'] = market_cap
+    valuation['pe'] = _ratio(daily['close'], daily['epsdiluted'])
+    valuation['pb'] = _ratio(market_cap, daily['totalStockholdersEquity'])
+    valuation['ev_ebitda'] = _ratio(market_cap + daily['netDebt'].fillna(0), daily['ebitda'])
+    valuation['fcf_yield'] = _ratio(daily['freeCashFlow'], market_cap)
+    return valuation.sort_values(['symbol', 'date'], kind='stable')
+
+
+def build_valuation(conn, since=None):
+    """Compute the daily point-in-time 'valuation' table in batches of symbols and upsert it.
+
+    With `since` ({symbol: 'yyyy-mm-dd'}, the earliest price/statement high-water mark before the load) only the
+    days on/after each symbol's mark are written, which covers both new prices and newly accepted filings.
+    """
+    since = since or {}
+    create_table(conn, 'valuation', VALUATION_SCHEMA, PRICE_KEY)
+    rows = 0
+    for symbols in symbol_batches(conn):
+        filings = [read_filings(conn, table, annual, columns, symbols) for table, annual, columns in VALUATION_INPUTS]
+        valuation = compute_valuation(read_prices(conn, symbols, columns=('close',)), filings)
+        valuation = valuation[valuation['date'] >= valuation['symbol'].map(since).fillna('')]
+        with bulk_load(conn):
+            rows += insert_frame(conn, 'valuation', valuation, key=PRICE_KEY)
+    return rows
+
+
+#########################  OHLCV rollups  #########################
+
+# Rollup tables and the numpy unit their periods start on ('W' is handled as weeks starting on Monday)
+ROLLUPS = {
+    'prices_weekly': 'W',
+    'prices_monthly': 'M',
+    'prices_yearly': 'Y',
+}
+
+# One row per symbol and calendar period, keyed on the period's first calendar day
+ROLLUP_KEY = ('symbol', 'period_start')
+
+ROLLUP_SCHEMA = {
+    'period_start': 'DATE',
+    'last_date': 'DATE',
+    'open': 'DOUBLE',
+    'high': 'DOUBLE',
+    'low': 'DOUBLE',
+    'close': 'DOUBLE',
+    'volume': 'INTEGER',
+    'trading_days': 'INTEGER',
+    'symbol': 'VARCHAR(20)',
+}
+
+
+def period_starts(dates, unit):
+    """First calendar day ('yyyy-mm-dd') of the week / month / year of each 'yyyy-mm-dd' date."""
+    days = np.asarray(dates, dtype='datetime64[D]')
+    if unit == 'W':
+        # 1970-01-01 was a Thursday, so (days since epoch + 3) % 7 is the weekday with Monday = 0
+        starts = days - (days.astype('int64') + 3) % 7
+    else:
+        starts = days.astype(f'datetime64[{unit}]').astype('datetime64[D]')
+    return starts.astype(str)
+
+
+def compute_rollup(prices, unit):
+    """OHLCV bars per symbol and period from daily prices sorted by symbol and date."""
+    prices = prices.assign(period_start=period_starts(prices['date'], unit))
+    bars = prices.groupby(['symbol', 'period_start'], sort=False).agg(
+        last_date=('date', 'last'), open=('open', 'first'), high=('high', 'max'), low=('low', 'min'),
+        close=('close', 'last'), volume=('volume', 'sum'), trading_days=('date', 'size'))
+    return bars.reset_index()[list(ROLLUP_SCHEMA)]
+
+
+def build_rollups(conn, since=None):
+    """Maintain the weekly, monthly and yearly OHLCV tables from 'stock_prices'.
+
+    With `since` ({symbol: 'yyyy-mm-dd'}, the price high-water marks before the load) only the prices from the
+    earliest start of the week, month or year holding the mark are read (a week can start in the previous year)
+    and only the periods containing new bars are rewritten.
+    Returns {table: rows upserted}.
+    """
+    since = since or {}
+    rows = dict.fromkeys(ROLLUPS, 0)
+    for table in ROLLUPS:
+        create_table(conn, table, ROLLUP_SCHEMA, ROLLUP_KEY)
+    for symbols in symbol_batches(conn):
+        marks = [since.get(symbol) for symbol in symbols]
+        start = '' if None in marks else min(period_starts(min(marks), unit).item() for unit in ROLLUPS.values())
+        prices = read_prices(conn, symbols, columns=('open', 'high', 'low', 'close', 'volume'), start=start)
+        for table, unit in ROLLUPS.items():
+            bars = compute_rollup(prices, unit)
+            # Periods from the one holding the symbol's mark onwards (every period for a symbol without a mark)
+            first_changed = period_starts(bars['symbol'].map(since).fillna('0001-01-01'), unit)
+            bars = bars[bars['period_start'] >= first_changed]
+            with bulk_load(conn):
+                rows[table] += insert_frame(conn, table, bars, key=ROLLUP_KEY)
+    return rows
@@ -0,0 +1,128 @@
+### Parallel loader for the fundamentals pickle (income, balance sheet and cash flow statements), with a bounded write buffer
+import os
+import pickle
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import pandas as pd
+from ingest import (DROPPED_STATEMENT_COLUMNS, STATEMENT_KEY, STATEMENTS, bulk_load, insert_frame, load_high_water_marks,
+                    since_high_water_mark, strip_exchange_suffix, update_high_water_marks)
+from schema import coerce_frame, create_table, declared_schema, infer_schema
+
+
+# Default ceiling (in MB) for the normalised statement rows held in memory before they are written to the DB
+MEMORY_CEILING_MB = 256
+
+
+def iter_pickled_items(path):
+    """Yield the (key, value) pairs of a pickled dict, dropping each entry as soon as it has been handed out.
+
+    A pickle cannot be read partially, so the whole dict is loaded first and shrinks as its entries are consumed.
+    """
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    while data:
+        key = next(iter(data))
+        yield key, data.pop(key)
+
+
+def normalize_statements(raw):
+    """Worker: one stock's raw statements -> {statement: dataframe}, with 'link' columns dropped and '.NS' stripped."""
+    frames = {}
+    for statement in STATEMENTS:
+        stmt_df = pd.DataFrame(raw.get(statement, []))
+        stmt_df = stmt_df.drop(columns=DROPPED_STATEMENT_COLUMNS, errors='ignore')
+        if 'symbol' in stmt_df.columns:
+            stmt_df['symbol'] = strip_exchange_suffix(stmt_df['symbol'])
+        frames[statement] = stmt_df
+    return frames
+
+
+class StatementWriter:
+    """Buffers normalised per-stock statements and upserts them into the DB whenever the buffer reaches the memory ceiling."""
+
+    def __init__(self, conn, memory_ceiling_mb=MEMORY_CEILING_MB):
+        self.conn = conn
+        self.ceiling = memory_ceiling_mb * 2**20
+        self.buffer = {statement: [] for statement in STATEMENTS}
+        self.buffered = 0
+        self.rows = dict.fromkeys(STATEMENTS, 0)
+        # Columns that were empty in every stock so far, they are only created once a value (or the end) is seen
+        self.empty_columns = {statement: {} for statement in STATEMENTS}
+        self.marks = {statement: load_high_water_marks(conn, statement) for statement in STATEMENTS}
+
+    def add(self, frames):
+        for statement, stmt_df in frames.items():
+            if not stmt_df.empty:
+                self.buffer[statement].append(stmt_df)
+                self.buffered += stmt_df.memory_usage(deep=True).sum()
+        if self.buffered >= self.ceiling:
+            self.flush()
+
+    def flush(self):
+        for statement in STATEMENTS:
+            if self.buffer[statement]:
+                self._write(statement, pd.concat(self.buffer[statement], ignore_index=True))
+            self.buffer[statement] = []
+        self.buffered = 0
+
+    def _write(self, statement, stmt_df):
+        # All-NULL columns tell nothing about the column type, leave them out until some stock has a value
+        declared = declared_schema(self.conn, statement)
+        empty = [column for column in stmt_df.columns if column not in declared and stmt_df[column].isna().all()]
+        self.empty_columns[statement].update(dict.fromkeys(empty))
+        stmt_df = stmt_df.drop(columns=empty)
+        for column in stmt_df.columns:
+            self.empty_columns[statement].pop(column, None)
+
+        # Create / widen the table with the column types inferred from this batch and convert the data to them
+        column_types = create_table(self.conn, statement, infer_schema(stmt_df), STATEMENT_KEY)
+        stmt_df = coerce_frame(stmt_df, column_types)
+
+        # Keep only filings accepted on/after the last loaded 'acceptedDate' of each symbol (new or restated rows)
+        stmt_df = since_high_water_mark(stmt_df, self.marks[statement], 'acceptedDate')
+        # Latest filing wins when the same (symbol, date, period) is restated
+        stmt_df = stmt_df.sort_values('acceptedDate', kind='stable')
+
+        with bulk_load(self.conn):
+            insert_frame(self.conn, statement, stmt_df, key=STATEMENT_KEY)
+            update_high_water_marks(self.conn, statement, stmt_df, 'acceptedDate')
+        self.rows[statement] += len(stmt_df)
+
+    def close(self):
+        """Write what is left in the buffer and create the columns that never had a value (as VARCHAR(20), like a full load)."""
+        self.flush()
+        for statement, columns in self.empty_columns.items():
+            if columns:
+                create_table(self.conn, statement, dict.fromkeys(columns, 'VARCHAR(20)'), STATEMENT_KEY)
+        return self.rows
+
+
+def load_fundamentals(conn, path, workers=None, memory_ceiling_mb=MEMORY_CEILING_MB):
+    """Normalise the statements of each stock in a process pool and stream them into the statement tables.
+
+    The raw pickle is loaded whole in this process (and released stock by stock), the workers are started from a
+    forkserver (spawn where there is none) so they do not inherit it. At most two stocks per worker are in flight,
+    and the normalised rows are written out whenever they reach `memory_ceiling_mb`: that buffer is what the
+    ceiling bounds, combined dataframes of all stocks are never built. Returns {statement: rows upserted}.
+    """
+    workers = workers or os.cpu_count() or 1
+    writer = StatementWriter(conn, memory_ceiling_mb)
+    items = iter_pickled_items(path)
+    if workers == 1:
+        for _, raw in items:
+            writer.add(normalize_statements(raw))
+        return writer.close()
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+        pending = set()
+        for _, raw in items:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    writer.add(future.result())
+            pending.add(pool.submit(normalize_statements, raw))
+            del raw
+        for future in pending:
+            writer.add(future.result())
+    return writer.close()
@@ -0,0 +1,170 @@
+### Bulk ingest helpers used by main.py to load the pickled data into SQLite
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+import numpy as np
+import pandas as pd
+
+
+# Number of rows written per transaction while streaming a dataframe into SQLite
+CHUNK_SIZE = 50_000
+
+# Natural keys used to upsert rows, new or restated rows replace the stored ones
+PRICE_KEY = ('symbol', 'date')
+STATEMENT_KEY = ('symbol', 'date', 'period')
+
+# Statements stored per stock in the fundamentals pickle, one table each
+STATEMENTS = ('income_statement', 'balancesheet_statement', 'cashflow_statement')
+
+# Columns of the statements that are not loaded into the DB
+DROPPED_STATEMENT_COLUMNS = ['link', 'finalLink']
+
+# Table holding the per-table, per-symbol high-water mark of the last ingested row
+STATE_TABLE = 'ingest_state'
+
+# PRAGMAs switched on while bulk loading a new DB (a negative cache_size is in KiB, so this is ~256 MB).
+# Without a journal a crash can corrupt the file, which is fine only because a full rebuild starts from scratch.
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -256000,
+}
+
+# PRAGMAs of an incremental refresh, which updates the existing DB in place: the write-ahead log (turned on by
+# main.py) keeps the DB consistent through a crash, synchronous=NORMAL only syncs it at checkpoints
+INCREMENTAL_LOAD_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -256000,
+}
+
+
+@contextmanager
+def bulk_load(conn, pragmas=None):
+    """Turn on bulk-load PRAGMAs for the duration of the block and restore the previous values afterwards.
+
+    By default a DB in WAL mode (an incremental refresh) gets INCREMENTAL_LOAD_PRAGMAS and keeps its journal,
+    any other DB the unsafe BULK_LOAD_PRAGMAS.
+    """
+    conn.commit()
+    if pragmas is None:
+        wal = conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        pragmas = INCREMENTAL_LOAD_PRAGMAS if wal else BULK_LOAD_PRAGMAS
+    saved = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in pragmas}
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    try:
+        yield conn
+    finally:
+        conn.commit()
+        for name, value in saved.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+
+
+def strip_exchange_suffix(symbols):
+    """'RELIANCE.NS' -> 'RELIANCE' for a whole column at once."""
+    return pd.Series(symbols).str.split('.', n=1).str[0].values
+
+
+def format_dates(values):
+    """Format Timestamps (or date strings) as 'yyyy-mm-dd' strings using vectorized numpy ops, missing dates become None."""
+    dates = pd.DatetimeIndex(pd.to_datetime(values, errors='coerce'))
+    if dates.tz is not None:
+        # Keep the exchange-local calendar day, same as reading `.year/.month/.day` off each Timestamp
+        dates = dates.tz_localize(None)
+    formatted = dates.values.astype('datetime64[D]').astype(str).astype(object)
+    formatted[dates.isna()] = None
+    return formatted
+
+
+def combine_prices(csp):
+    """Combine the per-symbol price dataframes into one 'stock_prices' shaped dataframe in a single pass."""
+    symbols = [key.split('.')[0] for key in csp.keys()]
+    comb_df = pd.concat(list(csp.values()), keys=symbols, names=['symbol', 'date'])
+    comb_df = comb_df.reset_index()
+    comb_df.columns = [str(col).lower() for col in comb_df.columns]
+    comb_df['date'] = format_dates(comb_df['date'])
+    return comb_df[['date', 'open', 'high', 'low', 'close', 'volume', 'symbol']]
+
+
+def _column_values(series):
+    # Numpy numeric columns convert straight to Python int/float (NaN is stored as NULL by SQLite),
+    # everything else goes through object dtype so that missing values are bound as None
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+        return series.tolist()
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def insert_frame(conn, table, df, chunk_size=CHUNK_SIZE, key=None):
+    """Stream the rows of `df` into `table` as typed Python values, committing one transaction per chunk.
+
+    With `key` (the table's primary key columns) rows are upserted, so re-running a load is idempotent.
+    """
+    columns = df.columns.tolist()
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    if key:
+        # Clustered (WITHOUT ROWID) tables cannot store a NULL key
+        df = df.dropna(subset=list(key))
+        updates = ', '.join(f"{col} = excluded.{col}" for col in columns if col not in key)
+        query += f" ON CONFLICT ({', '.join(key)}) DO UPDATE SET {updates}"
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        with conn:
+            conn.executemany(query, zip(*(_column_values(chunk[col]) for col in columns)))
+    return len(df)
+
+
+### High-water marks for incremental loads
+
+def has_state_table(db_path):
+    """True if `db_path` is a DB built by this loader, i.e. it can be refreshed incrementally."""
+    if not os.path.isfile(db_path):
+        return False
+    with closing(sqlite3.connect(db_path)) as conn:
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (STATE_TABLE,)).fetchone()
+    return row is not None
+
+
+def create_state_table(conn):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {STATE_TABLE}(
+                          table_name VARCHAR(40),
+                          symbol VARCHAR(20),
+                          high_water_mark DATE,
+                          PRIMARY KEY (table_name, symbol));''')
+    conn.commit()
+
+
+def load_high_water_marks(conn, table):
+    """{symbol: last ingested 'yyyy-mm-dd'} for `table`."""
+    rows = conn.execute(f"SELECT symbol, high_water_mark FROM {STATE_TABLE} WHERE table_name = ?", (table,))
+    return dict(rows.fetchall())
+
+
+def earliest_marks(marks):
+    """Per symbol, the earliest of several {symbol: mark} dicts. Symbols missing from any of them have no mark."""
+    marks = list(marks)
+    common = set.intersection(*(set(m) for m in marks)) if marks else set()
+    return {symbol: min(m[symbol] for m in marks) for symbol in common}
+
+
+def since_high_water_mark(df, marks, column):
+    """Keep the rows at or after each symbol's high-water mark.
+
+    The mark itself is kept so that a restated last row (e.g. an intraday bar or a same-day refiling) is upserted again.
+    """
+    if not marks or df.empty:
+        return df
+    mark = df['symbol'].map(marks).fillna('')
+    return df[df[column].fillna('').astype(str) >= mark]
+
+
+def update_high_water_marks(conn, table, df, column):
+    """Move each symbol's high-water mark forward to the latest `column` value loaded from `df`."""
+    if df.empty:
+        return
+    latest = df.groupby('symbol')[column].max().dropna()
+    with conn:
+        conn.executemany(f'''
+        INSERT INTO {STATE_TABLE} (table_name, symbol, high_water_mark) VALUES (?, ?, ?)
+        ON CONFLICT (table_name, symbol) DO UPDATE SET high_water_mark = MAX(high_water_mark, excluded.high_water_mark)''',
+                         [(table, symbol, mark) for symbol, mark in latest.items()])
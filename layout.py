@@ -0,0 +1,112 @@
+### Physical layout of 'stock_db.sqlite': clustered tables, secondary indexes, planner statistics
+# Run `python layout.py` to print the query-plan report for an existing DB
+import re
+import sqlite3
+from derived import ROLLUP_KEY, ROLLUPS
+from ingest import PRICE_KEY, STATEMENT_KEY, STATEMENTS
+from schema import create_table_sql, declared_schema
+
+
+# Every table is stored as a WITHOUT ROWID b-tree clustered on its natural key,
+# so "symbol = ? AND date BETWEEN ? AND ?" is a single range read
+CLUSTER_KEYS = {
+    'stock_prices': PRICE_KEY,
+    'income_statement': STATEMENT_KEY,
+    'balancesheet_statement': STATEMENT_KEY,
+    'cashflow_statement': STATEMENT_KEY,
+    'price_metrics': PRICE_KEY,
+    'valuation': PRICE_KEY,
+    **dict.fromkeys(ROLLUPS, ROLLUP_KEY),
+}
+
+# Secondary indexes (name, table, columns) for the filters that do not start with 'symbol'
+INDEXES = [
+    ('idx_stock_prices_date', 'stock_prices', ('date',)),
+    ('idx_income_statement_year_period', 'income_statement', ('calendarYear', 'period')),
+    ('idx_balancesheet_statement_year_period', 'balancesheet_statement', ('calendarYear', 'period')),
+    ('idx_cashflow_statement_year_period', 'cashflow_statement', ('calendarYear', 'period')),
+    # One symbol's annual (or quarterly) series in year order, without a sort or a scan of the year index
+    *[(f'idx_{table}_symbol_period_year', table, ('symbol', 'period', 'calendarYear')) for table in STATEMENTS],
+    ('idx_price_metrics_date', 'price_metrics', ('date',)),
+    ('idx_valuation_date', 'valuation', ('date',)),
+    *[(f'idx_{table}_period_start', table, ('period_start',)) for table in ROLLUPS],
+]
+
+# Queries shaped like the ones `sql_chain` in app.py generates (quoted identifiers, symbol/date filters, LIMIT)
+TYPICAL_QUERIES = [
+    '''SELECT "date", "close" FROM stock_prices WHERE "symbol" = 'RELIANCE' AND "date" BETWEEN '2023-01-01' AND '2023-12-31' ORDER BY "date" LIMIT 10;''',
+    '''SELECT "date", "open", "high" FROM stock_prices WHERE "symbol" = 'WIPRO' ORDER BY "date" DESC LIMIT 10;''',
+    '''SELECT "symbol", "close", "volume" FROM stock_prices WHERE "date" = (SELECT MAX("date") FROM stock_prices) ORDER BY "volume" DESC LIMIT 10;''',
+    '''SELECT "symbol", "date", "close" FROM stock_prices WHERE "symbol" IN ('TCS', 'INFY', 'WIPRO') AND "date" >= date('now', '-1 year');''',
+    '''SELECT "calendarYear", "revenue", "netIncome" FROM income_statement WHERE "symbol" = 'TCS' AND "calendarYear" >= 2021 ORDER BY "calendarYear" DESC LIMIT 10;''',
+    '''SELECT "symbol", "revenue" FROM income_statement WHERE "calendarYear" = 2023 AND "period" = 'FY' ORDER BY "revenue" DESC LIMIT 10;''',
+    '''SELECT "symbol", "totalDebt", "totalEquity" FROM balancesheet_statement WHERE "calendarYear" = 2023 LIMIT 10;''',
+    '''SELECT "symbol", "drawdown", "high_52w" FROM price_metrics WHERE "date" = '2024-06-28' ORDER BY "drawdown" LIMIT 10;''',
+    '''SELECT "date", "pe", "pb" FROM valuation WHERE "symbol" = 'INFY' AND "date" >= '2024-01-01' ORDER BY "date" LIMIT 10;''',
+    '''SELECT "period_start", "close" FROM prices_monthly WHERE "symbol" = 'RELIANCE' AND "period_start" >= '2000-01-01' ORDER BY "period_start";''',
+    '''SELECT "calendarYear", "freeCashFlow" FROM cashflow_statement WHERE "symbol" = 'INFY' AND "period" = 'FY' ORDER BY "calendarYear" LIMIT 10;''',
+]
+
+
+def is_clustered(conn, table):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row is not None and 'WITHOUT ROWID' in row[0].upper()
+
+
+def cluster_table(conn, table, key):
+    """Rebuild a heap (rowid) table as a WITHOUT ROWID table clustered on `key`, e.g. for a DB built by an older main.py."""
+    columns = declared_schema(conn, table)
+    if not columns or is_clustered(conn, table):
+        return False
+    not_null = ' AND '.join(f"{col} IS NOT NULL" for col in key)
+    conn.commit()
+    with conn:
+        conn.execute('BEGIN')
+        conn.execute(create_table_sql(f"{table}__clustered", columns, key))
+        conn.execute(f"INSERT OR REPLACE INTO {table}__clustered SELECT * FROM {table} WHERE {not_null} ORDER BY {', '.join(key)}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}__clustered RENAME TO {table}")
+    return True
+
+
+def build_layout(conn):
+    """Cluster the tables, create the secondary indexes and refresh the query planner statistics."""
+    for table, key in CLUSTER_KEYS.items():
+        if cluster_table(conn, table, key):
+            print(f"Table '{table}' rebuilt as a clustered WITHOUT ROWID table.")
+    for name, table, columns in INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+def query_plan(conn, query):
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+
+
+def uses_index(plan):
+    # Only "SEARCH ..." is served by an index. "SCAN <table>" reads the whole table and "SCAN <table> USING
+    # [COVERING] INDEX ..." the whole index, both are full scans
+    scans = [detail for detail in plan if re.match(r'SCAN (TABLE )?\w+', detail) and detail != 'SCAN CONSTANT ROW']
+    return not scans and any(detail.startswith('SEARCH ') for detail in plan)
+
+
+def query_plan_report(conn, queries=TYPICAL_QUERIES):
+    """Print the plan of each query and return the ones that still do a full table scan."""
+    full_scans = []
+    for query in queries:
+        plan = query_plan(conn, query)
+        status = 'index' if uses_index(plan) else 'FULL SCAN'
+        if status != 'index':
+            full_scans.append(query)
+        print(f"\n[{status}] {query}")
+        for detail in plan:
+            print(f"      {detail}")
+    print(f"\n{len(queries) - len(full_scans)}/{len(queries)} typical queries use an index.")
+    return full_scans
+
+
+if __name__ == '__main__':
+    conn = sqlite3.connect('stock_db.sqlite')
+    query_plan_report(conn)
+    conn.close()
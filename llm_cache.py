@@ -0,0 +1,157 @@
+### Persistent cache of LLM chain responses for app.py, stored in a local SQLite file
+# Exact-match lookups on the normalised input, plus an optional embedding-similarity tier for near repeats.
+# Entries expire after a TTL, the least recently used ones are evicted past a size limit, and every entry is
+# tied to the version of 'stock_db.sqlite' so a schema change or a data refresh invalidates the cache.
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+from schema import db_version
+from schema_retrieval import EMBEDDING_MODEL, embed
+
+
+# Settings, overridable through environment variables
+CACHE_PATH = os.environ.get('LLM_CACHE_PATH', 'llm_cache.sqlite')
+CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', 24 * 3600))                 # seconds
+CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 10000))
+# Cosine similarity needed for a near-repeat hit, 0 disables the embedding tier. Keep it high: questions that
+# differ only in a ticker or a year embed very close to each other.
+CACHE_SIMILARITY = float(os.environ.get('LLM_CACHE_SIMILARITY', 0))
+CACHE_EMBEDDING_MODEL = os.environ.get('LLM_CACHE_EMBEDDING_MODEL', EMBEDDING_MODEL)
+
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', str(text)).strip().casefold()
+
+
+def input_text(inputs, exact=False):
+    """The text a chain input is keyed on: the request for {"request": ...} inputs, the string itself (e.g. generated SQL) otherwise.
+
+    Whitespace and case are normalised unless `exact`, for inputs that embed SQL string literals ('TCS' is not 'tcs').
+    """
+    key = (lambda text: str(text)) if exact else normalize
+    if isinstance(inputs, dict):
+        if len(inputs) == 1:
+            return key(next(iter(inputs.values())))
+        return key(json.dumps(inputs, sort_keys=True, default=str))
+    return key(inputs)
+
+
+class ResponseCache:
+
+    def __init__(self, path=CACHE_PATH, db_path='stock_db.sqlite', ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES,
+                 similarity=CACHE_SIMILARITY, embedding_model=CACHE_EMBEDDING_MODEL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.embedding_model = embedding_model
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache(
+                              key VARCHAR(64) PRIMARY KEY,
+                              chain VARCHAR(40),
+                              data_version VARCHAR(16),
+                              response TEXT,
+                              embedding BLOB,
+                              created DOUBLE,
+                              last_used DOUBLE);''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_chain ON llm_cache (chain, data_version)")
+        self.conn.commit()
+        self.hits = {'exact': 0, 'similar': 0}
+        self.misses = 0
+
+    def _key(self, chain, text, version):
+        return hashlib.sha256(f"{chain}\x00{version}\x00{text}".encode()).hexdigest()
+
+    def _embed(self, text):
+        # Same encoder as the schema retriever when the models match, loaded on first use
+        return embed([text], self.embedding_model)[0]
+
+    def get(self, chain, inputs, semantic=False, exact=False):
+        """Cached response for `inputs` or None."""
+        text, version, now = input_text(inputs, exact), db_version(self.db_path), time.time()
+        with self._lock:
+            key, tier = self._key(chain, text, version), 'exact'
+            row = self.conn.execute("SELECT response FROM llm_cache WHERE key = ? AND created > ?",
+                                    (key, now - self.ttl)).fetchone()
+            if row is None and semantic and self.similarity > 0:
+                (key, row), tier = self._nearest(chain, text, version, now), 'similar'
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits[tier] += 1
+            self.conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return row[0]
+
+    def _nearest(self, chain, text, version, now):
+        rows = self.conn.execute('''SELECT key, embedding, response FROM llm_cache
+                                    WHERE chain = ? AND data_version = ? AND created > ? AND embedding IS NOT NULL''',
+                                 (chain, version, now - self.ttl)).fetchall()
+        if not rows:
+            return None, None
+        embeddings = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        scores = embeddings @ self._embed(text)
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None, None
+        return rows[best][0], (rows[best][2],)
+
+    def put(self, chain, inputs, response, semantic=False, exact=False):
+        text, version, now = input_text(inputs, exact), db_version(self.db_path), time.time()
+        embedding = self._embed(text).tobytes() if semantic and self.similarity > 0 else None
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (self._key(chain, text, version), chain, version, response, embedding, now, now))
+            self._evict(version, now)
+            self.conn.commit()
+
+    def _evict(self, version, now):
+        # Entries of an older DB version or past their TTL can never be served again
+        self.conn.execute("DELETE FROM llm_cache WHERE data_version != ? OR created <= ?", (version, now - self.ttl))
+        # Least recently used entries beyond the size limit
+        self.conn.execute('''DELETE FROM llm_cache WHERE key IN (
+                             SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)''', (self.max_entries,))
+
+    def wrap(self, chain, name, fingerprint='', semantic=False, exact=False, on_lookup=None):
+        """Runnable that answers from the cache and only calls `chain` (and stores its response) on a miss.
+
+        `fingerprint` (e.g. model name + prompt template) is part of the key, so changing the prompt or the model
+        does not serve answers cached for the old one. With `exact` the input is keyed as is, without normalising
+        whitespace and case. `on_lookup(hit)` is called after every lookup.
+        """
+        name = f"{name}:{hashlib.sha256(fingerprint.encode()).hexdigest()[:8]}"
+
+        def invoke(inputs):
+            response = self.get(name, inputs, semantic, exact)
+            if on_lookup:
+                on_lookup(response is not None)
+            if response is None:
+                response = chain.invoke(inputs)
+                self.put(name, inputs, response, semantic, exact)
+            return response
+
+        async def astream(inputs):
+            # Cache lookups touch SQLite and possibly the embedding model, keep them off the event loop
+            response = await asyncio.to_thread(self.get, name, inputs, semantic, exact)
+            if on_lookup:
+                on_lookup(response is not None)
+            if response is not None:
+                yield response
+                return
+            # A miss streams the chain's chunks as they come (ainvoke gets them joined) and caches the whole response
+            chunks = []
+            async for chunk in chain.astream(inputs):
+                chunks.append(chunk)
+                yield chunk
+            await asyncio.to_thread(self.put, name, inputs, ''.join(chunks), semantic, exact)
+
+        return RunnableLambda(invoke, afunc=astream, name=f"cached_{name}")
@@ -1,31 +1,30 @@
 # Import Required Packages
 import os
+import argparse
 import pickle
 import sqlite3
-import numpy as np
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import warnings
+from cube import CUBE_PATH, build_price_cube
+from derived import build_price_metrics, build_rollups, build_valuation
+from layout import build_layout, query_plan_report
+from fundamentals import MEMORY_CEILING_MB, load_fundamentals
+from ingest import (PRICE_KEY, STATEMENTS, bulk_load, combine_prices, create_state_table, earliest_marks, has_state_table,
+                    insert_frame, load_high_water_marks, since_high_water_mark, update_high_water_marks)
 warnings.filterwarnings('ignore')
 
+DB_PATH = 'stock_db.sqlite'
 
-#########################  Load Constituent Stock Prices data  #########################
 
-# Nifty 50 Constituent Price data
-csp = pickle.load(open('./data/constituent_stock_prices.pkl', 'rb'))
+def parse_args():
+    parser = argparse.ArgumentParser(description=f"Load the pickled Nifty 50 data into '{DB_PATH}'")
+    parser.add_argument('--incremental', action='store_true',
+                        help="upsert only new or restated rows into the existing DB instead of rebuilding it")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes used to normalise the fundamentals (default: number of CPUs, 1 = no pool)")
+    parser.add_argument('--memory-ceiling-mb', type=int, default=MEMORY_CEILING_MB,
+                        help="normalised statement rows buffered before being written to the DB (the raw pickle is loaded whole)")
+    return parser.parse_args()
 
-# Combine 50 dataframes into one, Add a column 'Symbol' to distinguish that the row data is for that particular company
-
-comb_df = pd.DataFrame(columns=['Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'Symbol'])
-
-for key in csp.keys():
-    tmp_df = csp[key].copy()
-    tmp_df.reset_index(inplace=True)
-    tmp_df['Symbol'] = key.split('.')[0]
-    comb_df = pd.concat([comb_df, tmp_df], ignore_index=True)
-
-#print(comb_df.head())
 
 # Remove any old 'stock_db.sqlite' file
 def check_and_delete_file(file_path):
@@ -37,276 +36,126 @@ def check_and_delete_file(file_path):
     else:
         print(f"File '{file_path}' does not exist. Creating new...")
 
-check_and_delete_file('stock_db.sqlite')
-
-### Create a SQLite Database (in-memory)
-# Connect to a sqlite DB (It will create it if it doesn't exists)
-conn = sqlite3.connect('stock_db.sqlite')
-print("Created DB successfully!")
-
-# Create a table 'stock_prices' in DB
-conn.execute('''
-CREATE TABLE IF NOT EXISTS stock_prices(
-                      date DATE,
-                      open DOUBLE,
-                      high DOUBLE,
-                      low DOUBLE,
-                      close DOUBLE,
-                      volume INT,
-                      symbol VARCHAR(20));''')
-
-conn.commit()
-print("\nTable 'stock_prices' created successfully!")
-
-# Function to convert the 'date' from Timestamp to String yyyy-mm-dd
-def convert_date(date):
-    yyyy = date.year
-    mm = date.month
-    dd = date.day
-    if mm<10:
-        mm = '0' + str(mm)
-    if dd<10:
-        dd = '0' + str(dd)
-    return f"{yyyy}-{mm}-{dd}"
-
-comb_df['Date'] = comb_df['Date'].apply(convert_date)
-
-# Insert data into stock_prices table
-conn.executemany('''
-INSERT INTO stock_prices (date, open, high, low, close, volume, symbol) VALUES (?, ?, ?, ?, ?, ?, ?)
-''', comb_df.values)
-conn.commit()
-print("Data inserted into 'stock_prices' successfully!")
-
-### Query the Database # Show table content
-# cursor = conn.execute('''
-# SELECT * from stock_prices limit 10;
-# ''')
-# for row in cursor:
-#     print(row)
-
-
-#########################  Load Constituent Stock Fundamentals data  #########################
-
-# Load second pickle file
-csf = pickle.load(open('./data/constituent_stock_fundamentals.pkl', 'rb'))
-
-# Select any one Stock. Each stock is a dictionary
-d1 = csf['ADANIENT.NS']
-
-# print(d1.keys())   =>  dict_keys(['income_statement', 'balancesheet_statement', 'cashflow_statement'])
-
-# Each stock has 3 different dataframes
-dd1 = pd.DataFrame(d1['income_statement'])            # dd1.shape => (51, 38)
-dd2 = pd.DataFrame(d1['balancesheet_statement'])      # dd2.shape => (49, 54)
-dd3 = pd.DataFrame(d1['cashflow_statement'])          # dd3.shape => (83, 40)
-
-
-# Combine 'income_statement' data for all stocks
-colm_list = pd.DataFrame(csf['ADANIENT.NS']['income_statement']).columns.tolist()
-
-income_df = pd.DataFrame(columns=colm_list)
 
-for key in csf.keys():
-    tmp_df = pd.DataFrame(csf[key]['income_statement']).copy()
-    income_df = pd.concat([income_df, tmp_df], ignore_index=True)
+def main():
+    args = parse_args()
 
-income_df['symbol'] = income_df['symbol'].apply(lambda x: x.split('.')[0])
+    #########################  Load Constituent Stock Prices data  #########################
 
-# print(income_df.shape)  =>  (2430, 38)
+    # Nifty 50 Constituent Price data
+    csp = pickle.load(open('./data/constituent_stock_prices.pkl', 'rb'))
 
-# Correct datatype for columns after combine operation
-for i in range(len(income_df.columns)):
-    if income_df.dtypes.values[i] !=  dd1.dtypes.values[i]:
-        income_df[income_df.columns[i]] = income_df[income_df.columns[i]].astype(dd1.dtypes.values[i])
+    # Combine 50 dataframes into one (single concat), Add a column 'symbol' to distinguish that the row data is for that particular company
+    # The 'date' column is formatted as String yyyy-mm-dd in the same pass
+    comb_df = combine_prices(csp)
+    del csp
 
+    #print(comb_df.head())
 
-# Combine 'balancesheet_statement' data for all stocks
-colm_list = pd.DataFrame(csf['ADANIENT.NS']['balancesheet_statement']).columns.tolist()
-
-balancesheet_df = pd.DataFrame(columns=colm_list)
-
-for key in csf.keys():
-    tmp_df = pd.DataFrame(csf[key]['balancesheet_statement']).copy()
-    balancesheet_df = pd.concat([balancesheet_df, tmp_df], ignore_index=True)
-
-balancesheet_df['symbol'] = balancesheet_df['symbol'].apply(lambda x: x.split('.')[0])
-
-# Correct datatype for columns after combine operation
-for i in range(len(income_df.columns)):
-    if balancesheet_df.dtypes.values[i] !=  dd2.dtypes.values[i]:
-        balancesheet_df[balancesheet_df.columns[i]] = balancesheet_df[balancesheet_df.columns[i]].astype(dd2.dtypes.values[i])
-
-
-# Combine 'cashflow_statement' data
-colm_list = pd.DataFrame(csf['ADANIENT.NS']['cashflow_statement']).columns.tolist()
-
-cashflow_df = pd.DataFrame(columns=colm_list)
-
-for key in csf.keys():
-    tmp_df = pd.DataFrame(csf[key]['cashflow_statement']).copy()
-    cashflow_df = pd.concat([cashflow_df, tmp_df], ignore_index=True)
-
-cashflow_df['symbol'] = cashflow_df['symbol'].apply(lambda x: x.split('.')[0])
-
-# Correct datatype for columns after combine operation
-for i in range(len(income_df.columns)):
-    if cashflow_df.dtypes.values[i] !=  dd3.dtypes.values[i]:
-        cashflow_df[cashflow_df.columns[i]] = cashflow_df[cashflow_df.columns[i]].astype(dd3.dtypes.values[i])
-
-
-# Remove unnecessary columns
-income_df.drop(columns=['link', 'finalLink'], inplace=True)
-balancesheet_df.drop(columns=['link', 'finalLink'], inplace=True)
-cashflow_df.drop(columns=['link', 'finalLink'], inplace=True)
-
-
-### Insert 'income_statement' data into SQLite DBstock prices
-
-# Create sql query to create 'income_statement' table with reqd cols and datatype
-income_table_template = '''
-CREATE TABLE IF NOT EXISTS income_statement(\n'''
-
-for i in range(len(income_df.columns)):
-    if 'date' in str.lower(income_df.columns[i]):
-        datatype = 'DATE'
-    elif 'year' in str.lower(income_df.columns[i]):
-        datatype = 'INTEGER'
-    elif income_df.dtypes.values[i] == 'object':
-        datatype = 'VARCHAR(20)'
-    elif income_df.dtypes.values[i] == 'int64':
-        datatype = 'INTEGER'
-    elif income_df.dtypes.values[i] == 'float64':
-        datatype = 'DOUBLE'
+    # Incremental mode needs a DB written by this script (with primary keys and high-water marks), else rebuild
+    incremental = args.incremental and has_state_table(DB_PATH)
+    if incremental:
+        print(f"Incremental mode: refreshing '{DB_PATH}' from the last loaded rows onwards.")
     else:
-        datatype = 'VARCHAR(20)'
-    income_table_template += f"      {income_df.columns[i]} {datatype}, \n"
-
-income_table_template = income_table_template[:-3] + f"\n      );"
-
-# print(income_table_template)  =>  "CREATE TABLE IF NOT EXISTS income_statement(..."
-
-# Create table 'income_statement' in DB
-conn.execute(income_table_template)
-conn.commit()
-print("\nTable 'income_statement' created successfully")
-
-
-# Function to convert acceptedDate
-def convert_accepted_date(date):
-    return date[:10]
-
-income_df['acceptedDate'] = income_df['acceptedDate'].apply(convert_accepted_date)
-
-# Form a Insert query for income_statement
-income_insert_template = "\nINSERT INTO income_statement ("
-
-for i in range(len(income_df.columns)):
-    income_insert_template += f"{income_df.columns[i]}, "
-
-income_insert_template = income_insert_template[:-2] + f") VALUES (?{', ?'*(len(income_df.columns)-1)})\n"
-# print(income_insert_template)  =>  "INSERT INTO income_statement (date, symbol, ..."
-
-# Insert income_statement data
-conn.executemany(income_insert_template, income_df.values)
-conn.commit()
-print("Data inserted into 'income_statement' successfully!")
-
-
-### Insert 'balancesheet_statement' data into SQLite DB
-
-# Create sql query to create 'balancesheet_statement' table with reqd cols and datatype
-balancesheet_table_template = '''
-CREATE TABLE IF NOT EXISTS balancesheet_statement(\n'''
-
-for i in range(len(balancesheet_df.columns)):
-    if 'date' in str.lower(balancesheet_df.columns[i]):
-        datatype = 'DATE'
-    elif 'year' in str.lower(balancesheet_df.columns[i]):
-        datatype = 'INTEGER'
-    elif balancesheet_df.dtypes.values[i] == 'object':
-        datatype = 'VARCHAR(20)'
-    elif balancesheet_df.dtypes.values[i] == 'int64':
-        datatype = 'INTEGER'
-    elif balancesheet_df.dtypes.values[i] == 'float64':
-        datatype = 'DOUBLE'
-    else:
-        datatype = 'VARCHAR(20)'
-    balancesheet_table_template += f"      {balancesheet_df.columns[i]} {datatype}, \n"
-
-balancesheet_table_template = balancesheet_table_template[:-3] + f"\n      );"
-
-# print(balancesheet_table_template)  =>  "CREATE TABLE IF NOT EXISTS balancesheet_statement(..."
-
-# Create table 'balancesheet_statement' in DB
-conn.execute(balancesheet_table_template)
-conn.commit()
-print("\nTable 'balancesheet_statement' created successfully")
-
-balancesheet_df['acceptedDate'] = balancesheet_df['acceptedDate'].apply(convert_accepted_date)
-
-# Form a Insert query for balancesheet_statement
-balancesheet_insert_template = "\nINSERT INTO balancesheet_statement ("
-
-for i in range(len(balancesheet_df.columns)):
-    balancesheet_insert_template += f"{balancesheet_df.columns[i]}, "
-
-balancesheet_insert_template = balancesheet_insert_template[:-2] + f") VALUES (?{', ?'*(len(balancesheet_df.columns)-1)})\n"
-# print(balancesheet_insert_template)  =>  "INSERT INTO balancesheet_statement (date, symbol, ..."
-
-# Insert balancesheet_statement data
-conn.executemany(balancesheet_insert_template, balancesheet_df.values)
-conn.commit()
-print("Data inserted into 'balancesheet_statement' successfully!")
-
-
-### Insert 'cashflow_statement' data into SQLite DB
-
-# Create sql query to create 'balancesheet_statement' table with reqd cols and datatype
-cashflow_table_template = '''
-CREATE TABLE IF NOT EXISTS cashflow_statement(\n'''
-
-for i in range(len(cashflow_df.columns)):
-    if 'date' in str.lower(cashflow_df.columns[i]):
-        datatype = 'DATE'
-    elif 'year' in str.lower(cashflow_df.columns[i]):
-        datatype = 'INTEGER'
-    elif cashflow_df.dtypes.values[i] == 'object':
-        datatype = 'VARCHAR(20)'
-    elif cashflow_df.dtypes.values[i] == 'int64':
-        datatype = 'INTEGER'
-    elif cashflow_df.dtypes.values[i] == 'float64':
-        datatype = 'DOUBLE'
-    else:
-        datatype = 'VARCHAR(20)'
-    cashflow_table_template += f"      {cashflow_df.columns[i]} {datatype}, \n"
-
-cashflow_table_template = cashflow_table_template[:-3] + f"\n      );"
-
-# print(cashflow_table_template)  =>  "CREATE TABLE IF NOT EXISTS cashflow_statement(..."
-
-# Create table 'cashflow_statement' in DB
-conn.execute(cashflow_table_template)
-conn.commit()
-print("\nTable 'cashflow_statement' created successfully")
-
-cashflow_df['acceptedDate'] = cashflow_df['acceptedDate'].apply(convert_accepted_date)
-
-# Form a Insert query for balancesheet_statement
-cashflow_insert_template = "\nINSERT INTO cashflow_statement ("
-
-for i in range(len(cashflow_df.columns)):
-    cashflow_insert_template += f"{cashflow_df.columns[i]}, "
-
-cashflow_insert_template = cashflow_insert_template[:-2] + f") VALUES (?{', ?'*(len(cashflow_df.columns)-1)})\n"
-# print(cashflow_insert_template)  =>  "INSERT INTO cashflow_statement (date, symbol, ..."
-
-# Insert cashflow_statement data
-conn.executemany(cashflow_insert_template, cashflow_df.values)
-conn.commit()
-print("Data inserted into 'cashflow_statement' successfully!")
-
-
-### Close the DB connection
-conn.close()
-print("DB connection closed!")
+        if args.incremental:
+            print(f"No ingest state found in '{DB_PATH}', falling back to a full rebuild.")
+        check_and_delete_file(DB_PATH)
+
+    ### Create a SQLite Database (in-memory)
+    # Connect to a sqlite DB (It will create it if it doesn't exists)
+    conn = sqlite3.connect(DB_PATH)
+    print("Created DB successfully!")
+    if incremental:
+        # The DB is updated in place, so keep it crash-safe: bulk_load() leaves the write-ahead log on in WAL mode
+        conn.execute("PRAGMA journal_mode = WAL")
+
+    # Table 'ingest_state' keeps the high-water mark (last 'date' / 'acceptedDate') per table and symbol
+    create_state_table(conn)
+    # Marks before this load, the derived tables are refreshed from them onwards
+    marks = {table: load_high_water_marks(conn, table) for table in ('stock_prices', *STATEMENTS)}
+
+    # Create a table 'stock_prices' in DB
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_prices(
+                          date DATE,
+                          open DOUBLE,
+                          high DOUBLE,
+                          low DOUBLE,
+                          close DOUBLE,
+                          volume INT,
+                          symbol VARCHAR(20),
+                          PRIMARY KEY (symbol, date)) WITHOUT ROWID;''')
+
+    conn.commit()
+    print("\nTable 'stock_prices' created successfully!")
+
+    # Keep only rows on/after the last loaded date of each symbol (all rows on a fresh DB)
+    comb_df = since_high_water_mark(comb_df, marks['stock_prices'], 'date')
+
+    # Upsert data into stock_prices table (typed rows, chunked transactions, bulk-load PRAGMAs on)
+    with bulk_load(conn):
+        insert_frame(conn, 'stock_prices', comb_df, key=PRICE_KEY)
+        update_high_water_marks(conn, 'stock_prices', comb_df, 'date')
+    print(f"{len(comb_df)} rows upserted into 'stock_prices' successfully!")
+    del comb_df
+
+    ### Query the Database # Show table content
+    # cursor = conn.execute('''
+    # SELECT * from stock_prices limit 10;
+    # ''')
+    # for row in cursor:
+    #     print(row)
+
+
+    #########################  Load Constituent Stock Fundamentals data  #########################
+
+    # Each stock in the pickle has 3 statements: 'income_statement', 'balancesheet_statement', 'cashflow_statement'.
+    # Stocks are normalised in parallel and streamed into a table per statement, with column types inferred from
+    # the data (INTEGER / DOUBLE for numbers, DATE as yyyy-mm-dd, VARCHAR(20) for text).
+    rows = load_fundamentals(conn, './data/constituent_stock_fundamentals.pkl',
+                             workers=args.workers, memory_ceiling_mb=args.memory_ceiling_mb)
+    for statement, count in rows.items():
+        print(f"{count} rows upserted into '{statement}' successfully!")
+
+
+    #########################  Derived tables  #########################
+
+    # Daily return, moving averages, volatility, drawdown and 52-week high/low per symbol and day
+    rows = build_price_metrics(conn, since=marks['stock_prices'])
+    print(f"\n{rows} rows upserted into 'price_metrics' successfully!")
+
+    # Daily P/E, P/B, EV/EBITDA and FCF yield from the latest statements filed ('acceptedDate') before each day
+    rows = build_valuation(conn, since=earliest_marks(marks.values()))
+    print(f"{rows} rows upserted into 'valuation' successfully!")
+
+    # Weekly, monthly and yearly OHLCV bars, only the periods holding new daily bars are rewritten
+    for table, count in build_rollups(conn, since=marks['stock_prices']).items():
+        print(f"{count} rows upserted into '{table}' successfully!")
+
+
+    ### Build the physical layout: clustered tables, secondary indexes and ANALYZE statistics
+    with bulk_load(conn):
+        build_layout(conn)
+    print("\nIndexes and planner statistics built successfully!")
+
+    # Check that the typical generated queries are served by an index
+    full_scans = query_plan_report(conn)
+    if full_scans:
+        print(f"WARNING: {len(full_scans)} typical queries scan a whole table or index, see their plans above.")
+
+
+    ### Write the memory-mapped price cube (symbol x trading day x OHLCV) for the analysis code
+    n_symbols, n_days = build_price_cube(conn)
+    print(f"\nPrice cube '{CUBE_PATH}' written successfully! ({n_symbols} symbols x {n_days} trading days)")
+
+
+    ### Close the DB connection
+    if incremental:
+        # Back to a rollback journal, so that the app can open the DB read-only without the -wal/-shm files
+        conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+    print("DB connection closed!")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+### Runs the generated SQL for app.py on pooled read-only connections, with a cache of the resulting DataFrames
+# Results are cached by normalised SQL text and by the DB version (schema.db_version), so a reload of
+# 'stock_db.sqlite' by main.py invalidates them, and the connections are reopened on the new file.
+# A cost guard refuses queries before and while they run (QueryRejected, with a hint to rewrite them):
+#   - joins: a large table listed in a FROM clause with a table that no join condition links to it (a cartesian product)
+#   - plan: a full scan of a large table inside a join loop (a join without a usable condition)
+#   - budget: SQLite's progress handler interrupts queries past a number of VM steps or seconds
+#   - rows: rows are fetched in chunks and the query is refused past a hard row cap, before the DataFrame is built
+# Usage:
+#     runner = QueryRunner()
+#     df = runner.run('SELECT "date", "close" FROM stock_prices WHERE "symbol" = \'TCS\' LIMIT 10')
+import os
+import re
+import time
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from schema import db_version
+
+
+# Settings, overridable through environment variables
+POOL_SIZE = int(os.environ.get('SQL_POOL_SIZE', 4))
+RESULT_CACHE_ENTRIES = int(os.environ.get('SQL_RESULT_CACHE_ENTRIES', 256))
+MAX_ROWS = int(os.environ.get('SQL_MAX_ROWS', 200_000))
+MAX_VM_STEPS = int(os.environ.get('SQL_MAX_VM_STEPS', 500_000_000))
+MAX_SECONDS = float(os.environ.get('SQL_MAX_SECONDS', 15))
+# Tables with more rows than this (from the ANALYZE statistics) must not be fully scanned inside a join
+LARGE_TABLE_ROWS = int(os.environ.get('SQL_LARGE_TABLE_ROWS', 50_000))
+
+# Rows fetched at a time, and VM steps between two calls of the progress handler
+FETCH_ROWS = 10_000
+PROGRESS_STEPS = 10_000
+
+
+# Keywords of the generated queries, whose case is folded in the result cache key (see normalize_sql)
+SQL_KEYWORDS = {'SELECT', 'DISTINCT', 'FROM', 'WHERE', 'AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'LIKE', 'GLOB', 'BETWEEN',
+                'EXISTS', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'NATURAL', 'ON', 'USING', 'AS',
+                'GROUP', 'BY', 'HAVING', 'ORDER', 'ASC', 'DESC', 'NULLS', 'FIRST', 'LAST', 'LIMIT', 'OFFSET', 'UNION',
+                'ALL', 'INTERSECT', 'EXCEPT', 'CASE', 'WHEN', 'THEN', 'ELSE', 'END', 'CAST', 'WITH', 'OVER',
+                'PARTITION', 'ROWS', 'RANGE', 'PRECEDING', 'FOLLOWING', 'CURRENT', 'ROW', 'UNBOUNDED', 'COLLATE',
+                'ESCAPE', 'RECURSIVE', 'FILTER', 'WINDOW'}
+
+
+class QueryRejected(Exception):
+    """A generated query refused by the cost guard, the message says how to rewrite it."""
+
+
+def clean_sql(text):
+    """The SQL statement of an LLM answer: without markdown fences, a leading 'SQLQuery:' label or a trailing ';'."""
+    text = re.sub(r"```(?:sql|sqlite)?", "", text, flags=re.IGNORECASE)
+    text = re.sub(r"^\s*SQLQuery:\s*", "", text, flags=re.IGNORECASE)
+    return text.strip().rstrip(';').strip()
+
+
+def normalize_sql(sql):
+    # Whitespace and keyword case do not change a query. String literals (ticker symbols, dates) do, and so does the
+    # case of identifiers: it names the DataFrame columns ('SELECT "Close"' returns a 'Close' column, not 'close')
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", clean_sql(sql))
+    fold = lambda match: match.group(0).lower() if match.group(0).upper() in SQL_KEYWORDS else match.group(0)
+    return ''.join(part if part[:1] in ('"', "'") else re.sub(r'\w+', fold, re.sub(r'\s+', ' ', part))
+                   for part in parts).strip()
+
+
+def large_tables(conn, min_rows=LARGE_TABLE_ROWS):
+    """Tables with at least `min_rows` rows according to 'sqlite_stat1' (written by ANALYZE in layout.py)."""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        return set()
+    return {table for table, stat in conn.execute("SELECT tbl, stat FROM sqlite_stat1")
+            if stat and int(stat.split()[0]) >= min_rows}
+
+
+def from_clauses(sql):
+    """[(table, alias or None, join constraint), ...] per FROM clause, for the tables listed after FROM (by ',' or JOIN).
+
+    Only the span between FROM and the next WHERE / GROUP / ORDER / LIMIT (or ')' of a subquery) is read, so the
+    commas of the select list are not taken for tables. The join constraint is 'ON ...', 'USING ...', 'NATURAL' or ''.
+    """
+    clauses = []
+    for span in re.findall(r'\bFROM\b(.*?)(?=\b(?:WHERE|GROUP|ORDER|LIMIT|HAVING|WINDOW|UNION|EXCEPT|INTERSECT)\b|\)|$)',
+                           sql, flags=re.IGNORECASE | re.DOTALL):
+        items = re.split(r'(,|\b(?:NATURAL\s+)?(?:(?:LEFT|RIGHT|FULL)\s+(?:OUTER\s+)?|INNER\s+|CROSS\s+)?JOIN\b)',
+                         span, flags=re.IGNORECASE)
+        tables, joiner = [], ''
+        for i, item in enumerate(items):
+            if i % 2:
+                joiner = item
+                continue
+            match = re.match(r'\s*"?(\w+)"?(?:\s+(?:AS\s+)?"?(\w+)"?)?\s*((?:ON|USING)\b.*)?$', item,
+                             flags=re.IGNORECASE | re.DOTALL)
+            if not match or match.group(1).upper() in SQL_KEYWORDS:
+                continue
+            table, alias, constraint = match.groups()
+            if alias and alias.upper() in SQL_KEYWORDS:
+                alias = None
+            if re.match(r'NATURAL\b', joiner, flags=re.IGNORECASE):
+                constraint = 'NATURAL'
+            tables.append((table, alias, (constraint or '').strip()))
+        clauses.append(tables)
+    return clauses
+
+
+def table_aliases(sql):
+    """{alias or table name: table} of the tables of every FROM clause (the plan names tables by their alias)."""
+    aliases = {}
+    for tables in from_clauses(sql):
+        for table, alias, _ in tables:
+            aliases[table] = table
+            if alias:
+                aliases[alias] = table
+    return aliases
+
+
+def check_joins(sql, large):
+    """Raise QueryRejected if a FROM clause lists a large table with tables that nothing links to it (a cartesian product).
+
+    Tables are linked by a comparison between columns of both (in an ON or the WHERE clause, e.g. sp."symbol" = i."symbol")
+    or by a USING / NATURAL join. The plan check alone misses e.g. 'FROM stock_prices sp, income_statement i WHERE
+    sp."symbol" = 'TCS'', planned as a scan of i with a keyed search of sp inside.
+    """
+    compared = re.findall(r'"?(\w+)"?\s*\.\s*"?\w+"?\s*(?:==?|<>|!=|<=|>=|<|>)\s*"?(\w+)"?\s*\.\s*"?\w+"?', sql)
+    for tables in from_clauses(sql):
+        if len(tables) < 2 or not any(table in large for table, _, _ in tables):
+            continue
+        names = {}
+        for i, (table, alias, _) in enumerate(tables):
+            names.setdefault(alias or table, i)
+            names.setdefault(table, i)
+        links = [(names[a], names[b]) for a, b in compared if a in names and b in names]
+        links += [(i - 1, i) for i, (_, _, constraint) in enumerate(tables)
+                  if re.match(r'(?:USING|NATURAL)\b', constraint, flags=re.IGNORECASE)]
+        # Tables reachable from the first one through the links
+        linked, added = {0}, True
+        while added:
+            added = False
+            for i, j in links:
+                if (i in linked) != (j in linked):
+                    linked |= {i, j}
+                    added = True
+        unlinked = [table for i, (table, _, _) in enumerate(tables) if i not in linked]
+        if unlinked:
+            raise QueryRejected(f"it pairs every row of '{tables[0][0]}' with every row of '{unlinked[0]}' (no join condition "
+                                f"between them). Join on \"symbol\" (and \"date\" / \"calendarYear\"), e.g. "
+                                f"a.\"symbol\" = b.\"symbol\", or query the tables separately.")
+
+
+def check_plan(conn, sql, large):
+    """Raise QueryRejected if a join involving a large table fully scans a table for every row of an outer loop."""
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    aliases = table_aliases(sql)
+    # Loops of one SELECT share the same parent in the plan, listed from the outermost to the innermost
+    loops = {}
+    for _, parent, _, detail in plan:
+        match = re.match(r'(SCAN|SEARCH) (?:TABLE )?(\w+)', detail)
+        if match:
+            loops.setdefault(parent, []).append((detail, aliases.get(match.group(2), match.group(2))))
+    for group in loops.values():
+        if not any(table in large for _, table in group):
+            continue
+        for detail, table in group[1:]:
+            # In an inner loop any "SCAN" reads the whole table (or index) again for each outer row, only "SEARCH" is keyed
+            if detail.startswith('SCAN ') and table in aliases.values():
+                raise QueryRejected(f"it scans all of '{table}' for every row of the other table (a join without a usable join "
+                                    f"condition). Join on \"symbol\" (and \"date\" / \"calendarYear\") and filter on \"symbol\".")
+
+
+class QueryRunner:
+
+    def __init__(self, db_path='stock_db.sqlite', pool_size=POOL_SIZE, cache_entries=RESULT_CACHE_ENTRIES,
+                 max_rows=MAX_ROWS, max_vm_steps=MAX_VM_STEPS, max_seconds=MAX_SECONDS):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.cache_entries = cache_entries
+        self.max_rows = max_rows
+        self.max_vm_steps = max_vm_steps
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._version = None
+        self._large_tables = set()
+        self._pool = queue.Queue()
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _refresh(self, version):
+        # A new DB version: cached results are stale and the open connections may point at a replaced file
+        with self._lock:
+            if version == self._version:
+                return
+            self._version = version
+            self._results.clear()
+            conn = self._connect()
+            self._large_tables = large_tables(conn)
+            conn.close()
+            old_pool, self._pool = self._pool, queue.Queue()
+            for _ in range(self.pool_size):
+                self._pool.put(None)        # connections are opened on first use
+        while not old_pool.empty():
+            conn = old_pool.get()
+            if conn is not None:
+                conn.close()
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            self.misses += 1
+            return None
+
+    def _store(self, key, df):
+        with self._lock:
+            if key[0] != self._version:
+                return
+            self._results[key] = df
+            while len(self._results) > self.cache_entries:
+                self._results.popitem(last=False)
+
+    def _execute(self, conn, sql):
+        check_joins(sql, self._large_tables)
+        check_plan(conn, sql, self._large_tables)
+
+        steps, deadline = 0, time.monotonic() + self.max_seconds
+
+        def over_budget():
+            nonlocal steps
+            steps += PROGRESS_STEPS
+            return steps > self.max_vm_steps or time.monotonic() > deadline
+
+        conn.set_progress_handler(over_budget, PROGRESS_STEPS)
+        try:
+            cursor = conn.execute(sql)
+            columns = [column[0] for column in cursor.description or []]
+            rows = []
+            while chunk := cursor.fetchmany(FETCH_ROWS):
+                rows += chunk
+                if len(rows) > self.max_rows:
+                    raise QueryRejected(f"it returns more than {self.max_rows} rows. Filter on \"symbol\" and \"date\", "
+                                        f"or use the prices_weekly / prices_monthly / prices_yearly tables for long periods.")
+        except sqlite3.OperationalError as e:
+            if str(e) != 'interrupted':
+                raise
+            raise QueryRejected(f"it was stopped after {steps} SQLite steps / {self.max_seconds:g}s. Filter on \"symbol\" "
+                                f"and \"date\", or use the derived tables (price_metrics, valuation, prices_*) instead of "
+                                f"recomputing from the daily rows.") from None
+        finally:
+            conn.set_progress_handler(None, 0)
+        import pandas as pd         # imported on first use (or by warmup()), not when app.py starts
+        return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+    def warmup(self):
+        """Open the pooled connections and import pandas ahead of the first query (e.g. from a background thread)."""
+        self._refresh(db_version(self.db_path))
+        pool, opened = self._pool, []
+        for _ in range(self.pool_size):
+            conn = pool.get()
+            opened.append(conn or self._connect())
+        for conn in opened:
+            pool.put(conn)
+        import pandas       # noqa: F401
+
+    def run(self, sql, on_lookup=None):
+        """DataFrame of the rows returned by `sql` (blocking, waits for a free connection when all are in use).
+
+        Raises QueryRejected when the cost guard refuses the query, sqlite3.Error when SQLite does.
+        The cached DataFrame is shared between requests, callers must not modify it in place.
+        `on_lookup(hit)` is called after the result cache lookup.
+        """
+        version = db_version(self.db_path)
+        if version != self._version:
+            self._refresh(version)
+        key = (version, normalize_sql(sql))
+        df = self._cached(key)
+        if on_lookup:
+            on_lookup(df is not None)
+        if df is not None:
+            return df
+
+        pool = self._pool
+        conn = pool.get() or self._connect()
+        try:
+            df = self._execute(conn, clean_sql(sql))
+        finally:
+            conn.rollback()
+            pool.put(conn)
+        self._store(key, df)
+        return df
@@ -0,0 +1,286 @@
+### Pool of pre-warmed worker processes running the generated analysis code
+# Each worker imports pandas, NumPy, matplotlib and seaborn and opens a read-only connection to 'stock_db.sqlite'
+# once, then runs one snippet at a time with its own CPU time, wall-clock and memory limits. A worker that times out
+# or dies is replaced, so a runaway snippet only costs its own request.
+# Figures are returned as PNG bytes instead of image files: savefig() to a path and figures left open are captured in
+# memory, so concurrent requests never share (or clean up) a directory.
+# Usage (output: what the code printed, followed by the repr of its exception if it raised one, also returned as error):
+#     pool = SandboxPool()
+#     output, figures, error = pool.run("print(1 + 1)")
+#     output, figures, error = pool.run("df.plot(); print(df.describe())", {'df': df})    # variables the snippet starts with
+#     figures -> [('figure_1.png', b'\x89PNG...'), ...]
+#     pool.run(code, on_output=print)         # called from the calling thread with the printed text as it comes
+import io
+import os
+import re
+import sys
+import time
+import queue
+import signal
+import socket
+import sqlite3
+import threading
+import contextlib
+import subprocess
+from multiprocessing.connection import Connection
+
+
+# Seconds between two sends of the printed output while a snippet runs
+OUTPUT_INTERVAL = 0.1
+
+# Settings, overridable through environment variables
+POOL_SIZE = int(os.environ.get('SANDBOX_WORKERS', os.cpu_count() or 1))
+CPU_SECONDS = int(os.environ.get('SANDBOX_CPU_SECONDS', 30))
+WALL_SECONDS = float(os.environ.get('SANDBOX_WALL_SECONDS', 60))
+MEMORY_MB = int(os.environ.get('SANDBOX_MEMORY_MB', 1024))
+
+DB_PATH = 'stock_db.sqlite'
+
+
+class CPUTimeExceeded(Exception):
+    pass
+
+
+class SharedConnection(sqlite3.Connection):
+    """The worker's read-only connection, handed out by sqlite3.connect(DB_PATH); closing it is a no-op."""
+
+    def close(self):
+        self.rollback()
+
+
+def sanitize_input(code):
+    # Same clean-up as PythonREPL: drop markdown fences and a leading 'python'
+    code = re.sub(r"^(\s|`)*(?i:python)?\s*", "", code)
+    return re.sub(r"(\s|`)*$", "", code)
+
+
+def _address_space():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _preload(db_path):
+    # One BLAS thread per worker, the pool itself spreads the snippets over the cores
+    os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    import numpy, pandas, seaborn      # noqa: F401  (imported once, snippets find them in sys.modules)
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+
+    # Snippets call sqlite3.connect('stock_db.sqlite'): hand them the already open read-only connection instead
+    connect = sqlite3.connect
+    shared = connect(f"file:{db_path}?mode=ro", uri=True, factory=SharedConnection)
+    db_file = os.path.abspath(db_path)
+
+    def connect_shared(database, *args, **kwargs):
+        if isinstance(database, (str, os.PathLike)) and os.path.abspath(database) == db_file:
+            return shared
+        return connect(database, *args, **kwargs)
+
+    sqlite3.connect = connect_shared
+    return shared, matplotlib.pyplot
+
+
+class StreamedOutput(io.StringIO):
+    """stdout of a snippet: kept whole for the result, and sent to the pool in complete lines as it is printed."""
+
+    def __init__(self, conn):
+        super().__init__()
+        self.conn = conn
+        self._sent = 0
+        self._last_send = 0.0           # the first line goes out right away
+
+    def write(self, text):
+        written = super().write(text)
+        if '\n' in text and time.monotonic() - self._last_send >= OUTPUT_INTERVAL:
+            self.send(self.getvalue().rindex('\n') + 1)
+        return written
+
+    def send(self, end=None):
+        value = self.getvalue()
+        end = len(value) if end is None else end
+        if end > self._sent:
+            self.conn.send(('output', value[self._sent:end]))
+            self._sent, self._last_send = end, time.monotonic()
+
+
+class FigureCapture:
+    """Keeps the PNG of every figure a snippet saves to a file or leaves open, nothing is written to disk."""
+
+    def __init__(self, plt):
+        from matplotlib.figure import Figure
+        self.plt = plt
+        self.figures = []
+        self._saved = set()
+        savefig = Figure.savefig
+
+        def savefig_to_memory(fig, fname, *args, **kwargs):
+            if not isinstance(fname, (str, os.PathLike)):
+                return savefig(fig, fname, *args, **kwargs)
+            buffer = io.BytesIO()
+            savefig(fig, buffer, *args, **{**kwargs, 'format': 'png'})
+            name = os.path.splitext(os.path.basename(os.fspath(fname)))[0]
+            self.figures.append((f"{name}.png", buffer.getvalue()))
+            self._saved.add(id(fig))
+
+        Figure.savefig = savefig_to_memory
+
+    def collect(self):
+        """[(name, PNG bytes)] of the snippet: the figures it saved, then the ones it drew but did not save."""
+        for num in self.plt.get_fignums():
+            fig = self.plt.figure(num)
+            if fig.axes and id(fig) not in self._saved:
+                fig.savefig(f"figure_{num}.png")
+        figures = self.figures
+        self.reset()
+        return figures
+
+    def reset(self):
+        self.figures, self._saved = [], set()
+        self.plt.close('all')
+
+
+def _worker_main(conn, db_path, cpu_seconds, memory_mb):
+    import resource
+
+    shared, plt = _preload(db_path)
+    capture = FigureCapture(plt)
+
+    # Memory: address space the snippet may add on top of the preloaded worker, a MemoryError past it
+    limit = _address_space() + memory_mb * 2**20
+    resource.setrlimit(resource.RLIMIT_AS, (limit, resource.RLIM_INFINITY))
+
+    def on_cpu_limit(signum, frame):
+        raise CPUTimeExceeded(f"CPU time limit of {cpu_seconds}s exceeded")
+    signal.signal(signal.SIGXCPU, on_cpu_limit)
+
+    conn.send('ready')
+    while True:
+        try:
+            code, variables, stream = conn.recv()
+        except EOFError:
+            break
+        # CPU time: RLIMIT_CPU counts the whole process, so the soft limit is moved past the time used so far
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime)
+        resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, resource.RLIM_INFINITY))
+
+        output = StreamedOutput(conn) if stream else io.StringIO()
+        figures, error, recycle = [], None, False
+        try:
+            with contextlib.redirect_stdout(output):
+                # Fresh globals per snippet, nothing leaks from one request to the next
+                exec(sanitize_input(code), {'__name__': '__main__', **variables})
+                figures = capture.collect()
+        except MemoryError as e:
+            error, recycle = repr(e), True
+        except Exception as e:
+            error = repr(e)
+        finally:
+            resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+            capture.reset()
+            shared.rollback()
+        result = output.getvalue() + (error or '')
+        if stream:
+            output.send()
+        # A worker that ran out of memory may be left fragmented, the pool starts a fresh one
+        conn.send(('result', result, figures, error, recycle))
+        if recycle:
+            break
+
+
+class Worker:
+    """One worker process, started as 'python sandbox.py <fd> ...' and talking to the pool over a socket pair.
+
+    Plain subprocesses rather than multiprocessing ones: forking the app process (event loop, threads) is unsafe, and
+    multiprocessing's 'spawn' / 'forkserver' re-run the parent's __main__ module in every worker.
+    """
+
+    def __init__(self, db_path, cpu_seconds, memory_mb):
+        parent_socket, child_socket = socket.socketpair()
+        fd = child_socket.fileno()
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(fd), db_path, str(cpu_seconds),
+                                         str(memory_mb)], pass_fds=[fd])
+        child_socket.close()
+        self.conn = Connection(parent_socket.detach())
+        self.ready = False
+
+    def wait_ready(self):
+        if not self.ready:
+            self.ready = self.conn.recv() == 'ready'
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+        self.conn.close()
+
+
+class SandboxPool:
+
+    def __init__(self, size=POOL_SIZE, cpu_seconds=CPU_SECONDS, wall_seconds=WALL_SECONDS, memory_mb=MEMORY_MB,
+                 db_path=DB_PATH):
+        self.size = size
+        self.wall_seconds = wall_seconds
+        self._worker_args = (db_path, cpu_seconds, memory_mb)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        # Workers start loading in parallel right away, run() only waits for the one it picks up
+        for _ in range(size):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self):
+        worker = Worker(*self._worker_args)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _replace(self, worker):
+        worker.stop()
+        with self._lock:
+            self._workers.remove(worker)
+        self._idle.put(self._start_worker())
+
+    def run(self, code, variables=None, on_output=None):
+        """Run `code` in an idle worker (blocking until one is free), return what it printed, its figures and its error.
+
+        `variables` ({name: picklable value}, e.g. a DataFrame) are defined in the snippet's globals.
+        `on_output(text)` is called with the printed lines while the snippet runs, the result always has the whole output.
+        """
+        worker = self._idle.get()
+        try:
+            worker.wait_ready()
+            worker.conn.send((code, variables or {}, on_output is not None))
+            deadline = time.monotonic() + self.wall_seconds
+            while True:
+                if not worker.conn.poll(max(deadline - time.monotonic(), 0)):
+                    self._replace(worker)
+                    error = repr(TimeoutError(f"Execution timed out after {self.wall_seconds:g}s"))
+                    return error, [], error
+                message = worker.conn.recv()
+                if message[0] == 'result':
+                    break
+                on_output(message[1])
+            _, result, figures, error, recycle = message
+        except (EOFError, OSError) as e:
+            # The worker died (e.g. killed by the OS) or could not start
+            self._replace(worker)
+            error = repr(RuntimeError(f"Execution worker failed: {e!r}"))
+            return error, [], error
+        if recycle:
+            self._replace(worker)
+        else:
+            self._idle.put(worker)
+        return result, figures, error
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+            self._workers.clear()
+
+
+if __name__ == '__main__':
+    fd, db_path, cpu_seconds, memory_mb = sys.argv[1:]
+    _worker_main(Connection(int(fd)), db_path, int(cpu_seconds), int(memory_mb))
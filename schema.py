@@ -0,0 +1,172 @@
+### Column type inference shared by the statement tables, and the table DDL used in the app.py prompts
+# pandas is imported by the type inference functions themselves: app.py only needs the DDL and DB version helpers,
+# and importing pandas would slow down its start.
+import os
+import hashlib
+import sqlite3
+from contextlib import closing
+
+
+# Tables described to the LLM in the app.py prompts
+PROMPT_TABLES = ['stock_prices', 'income_statement', 'balancesheet_statement', 'cashflow_statement', 'price_metrics',
+                 'valuation', 'prices_weekly', 'prices_monthly', 'prices_yearly']
+
+# Extra description of the derived tables, added after their DDL in the prompts
+TABLE_NOTES = {
+    'price_metrics': "precomputed per symbol and trading day from stock_prices: daily_return (close over previous close - 1), "
+                     "ma_20 / ma_50 / ma_200 (moving averages of close), volatility_20 (annualised 20-day volatility of daily returns), "
+                     "drawdown (close over the highest close so far - 1), high_52w / low_52w (highest high / lowest low of the last 252 trading days). "
+                     "Use it instead of computing these from stock_prices.",
+    'valuation': "point-in-time ratios per symbol and trading day, using only the statements filed (acceptedDate) before that day: "
+                 "close, accepted_date (latest filing used), market_cap (close x diluted shares), pe (close / diluted EPS), "
+                 "pb (market_cap / stockholders equity), ev_ebitda ((market_cap + net debt) / EBITDA), fcf_yield (free cash flow / market_cap). "
+                 "Earnings, EBITDA and free cash flow are from annual (FY) filings; ratios on a zero or negative base are NULL. "
+                 "Use it instead of joining stock_prices with the statement tables.",
+    **{table: f"{resolution} OHLCV bars per symbol built from stock_prices: period_start (first calendar day of the {period}), "
+              f"last_date (last trading day included), open (first open), high, low, close (last close), volume (total), trading_days."
+       for table, resolution, period in [('prices_weekly', 'weekly', 'week, a Monday'), ('prices_monthly', 'monthly', 'month'),
+                                         ('prices_yearly', 'yearly', 'year')]},
+}
+
+# Values outside this range cannot be stored as a SQLite INTEGER
+MAX_INTEGER = 2**63 - 1
+
+# Inferred types from narrowest to widest, a column seen with two of them is converted to the wider one
+TYPE_ORDER = ['INTEGER', 'DOUBLE', 'VARCHAR(20)']
+
+
+def infer_column_type(name, series):
+    """SQLite column type for one column: DATE (stored as 'yyyy-mm-dd'), INTEGER, DOUBLE or VARCHAR(20)."""
+    import pandas as pd
+    if 'date' in name.lower():
+        return 'DATE'
+    if 'year' in name.lower():
+        return 'INTEGER'
+    # Look at the Python values, not the dtype: statement columns with a missing value in some stock are 'object'
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind not in ('integer', 'floating', 'mixed-integer-float', 'decimal', 'boolean'):
+        return 'VARCHAR(20)'
+    values = pd.to_numeric(series, errors='coerce').astype('float64').dropna()
+    if (values % 1 == 0).all() and (values.abs() < MAX_INTEGER).all():
+        return 'INTEGER'
+    return 'DOUBLE'
+
+
+def infer_schema(df):
+    """{column: SQLite type} for every column of `df`, in column order."""
+    return {column: infer_column_type(column, df[column]) for column in df.columns}
+
+
+def widen_type(declared, inferred):
+    if declared is None:
+        return inferred
+    if declared in TYPE_ORDER and inferred in TYPE_ORDER:
+        return max(declared, inferred, key=TYPE_ORDER.index)
+    return declared
+
+
+def coerce_column(series, datatype):
+    """Convert a column to the values stored for `datatype` so SQLite keeps INTEGER/REAL affinity."""
+    import pandas as pd
+    from ingest import format_dates
+    if datatype == 'DATE':
+        return pd.Series(format_dates(series), index=series.index, dtype=object)
+    if datatype in ('INTEGER', 'DOUBLE'):
+        values = pd.to_numeric(series, errors='coerce')
+        if datatype == 'INTEGER' and (values.dropna() % 1 == 0).all():
+            return values.astype('Int64')
+        return values.astype('float64')
+    return series
+
+
+def coerce_frame(df, schema):
+    import pandas as pd
+    return pd.DataFrame({column: coerce_column(df[column], schema.get(column, 'VARCHAR(20)')) for column in df.columns})
+
+
+def create_table_sql(table, schema, key):
+    ddl = f"\nCREATE TABLE IF NOT EXISTS {table}(\n"
+    for column, datatype in schema.items():
+        ddl += f"      {column} {datatype}, \n"
+    ddl += f"      PRIMARY KEY ({', '.join(key)})\n      ) WITHOUT ROWID;"
+    return ddl
+
+
+def declared_schema(conn, table):
+    """{column: declared type} of an existing table, empty if the table does not exist."""
+    return {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def rebuild_table(conn, table, schema, key):
+    """Rebuild `table` with the declared types of `schema` (same columns), the column affinity converts the stored values."""
+    conn.commit()
+    with conn:
+        conn.execute('BEGIN')
+        conn.execute(create_table_sql(f"{table}__rebuilt", schema, key))
+        conn.execute(f"INSERT INTO {table}__rebuilt SELECT * FROM {table}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}__rebuilt RENAME TO {table}")
+
+
+def create_table(conn, table, schema, key):
+    """Create `table` (or add the columns it is missing) and return the column types the data must be coerced to.
+
+    Columns that already exist keep their declared type, unless the new data needs a wider one (e.g. a fraction in
+    an INTEGER column): the table is then rebuilt with the wider type, so an incremental (or batched) load ends up
+    with the same types and stored values as a full one. Indexes of a rebuilt table are recreated by layout.py.
+    """
+    conn.execute(create_table_sql(table, schema, key))
+    declared = declared_schema(conn, table)
+    widened = {column: widen_type(datatype, schema[column]) if column in schema else datatype
+               for column, datatype in declared.items()}
+    if widened != declared:
+        rebuild_table(conn, table, widened, key)
+        declared = widened
+    for column, datatype in schema.items():
+        if column not in declared:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {datatype}")
+    conn.commit()
+    return {column: widen_type(declared.get(column), datatype) for column, datatype in schema.items()}
+
+
+def table_ddl(table, schema):
+    """Prompt lines of one table: its 'CREATE TABLE ...' line with `schema` ({column: type}) and its note if any."""
+    columns = ', '.join(f"{column} {datatype}" for column, datatype in schema.items())
+    lines = [f"CREATE TABLE IF NOT EXISTS {table} ({columns});"]
+    if table in TABLE_NOTES:
+        lines.append(f"-- {table}: {TABLE_NOTES[table]}")
+    return lines
+
+
+def describe_tables(db_path, tables=PROMPT_TABLES):
+    """One 'CREATE TABLE ...' line per table with the declared column types, for the LLM prompts."""
+    with closing(sqlite3.connect(db_path)) as conn:
+        lines = []
+        for table in tables:
+            schema = declared_schema(conn, table)
+            if schema:
+                lines += table_ddl(table, schema)
+    return '\n'.join(lines)
+
+
+# DB versions already computed, by (path, mtime, size) of the DB file
+_db_versions = {}
+
+
+def db_version(db_path):
+    """Short hash of the DB schema and of the ingest high-water marks, it changes whenever main.py loads new data.
+
+    It is recomputed only when the DB file itself changes, so it is cheap enough to check on every request.
+    """
+    stat = os.stat(db_path)
+    file_key = (os.path.abspath(db_path), stat.st_mtime_ns, stat.st_size)
+    if file_key not in _db_versions:
+        digest = hashlib.sha256()
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            for (sql,) in conn.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY name"):
+                digest.update(sql.encode())
+            if declared_schema(conn, 'ingest_state'):
+                for row in conn.execute("SELECT table_name, symbol, high_water_mark FROM ingest_state ORDER BY 1, 2"):
+                    digest.update(repr(row).encode())
+        _db_versions[file_key] = digest.hexdigest()[:16]
+    return _db_versions[file_key]
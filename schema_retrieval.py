@@ -0,0 +1,239 @@
+### Schema retrieval for the app.py prompts: only the tables and columns relevant to a request are described
+# Every table and column of 'stock_db.sqlite' is embedded once at startup (name split into words, type and the
+# TABLE_NOTES description), then each request is embedded and the top-k tables with their top-k columns are
+# written as one-line DDL, instead of sending the full schema (well over 150 columns) with every LLM call.
+# Usage:
+#     retriever = SchemaRetriever('stock_db.sqlite')
+#     retriever = SchemaRetriever('stock_db.sqlite', background=True)   # embed in a thread, select() waits for it
+#     retriever.describe("monthly close of RELIANCE since 2015")    # the full schema if the embedding model failed
+#     python schema_retrieval.py "<request>" ...      # prompt size of the full vs the pruned schema
+#     python schema_retrieval.py --accuracy [--llm]   # the pruned schema keeps what correct queries need (and, with
+#                                                     # --llm, the SQL generated from it returns the same rows)
+import os
+import re
+import argparse
+import sqlite3
+import threading
+from contextlib import closing
+import numpy as np
+from schema import PROMPT_TABLES, TABLE_NOTES, declared_schema, describe_tables, table_ddl
+
+
+# Settings, overridable through environment variables
+EMBEDDING_MODEL = os.environ.get('SCHEMA_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+TOP_TABLES = int(os.environ.get('SCHEMA_TOP_TABLES', 3))
+TOP_COLUMNS = int(os.environ.get('SCHEMA_TOP_COLUMNS', 15))
+
+# Columns always described with their table on top of the key columns: the usual filters of the statement tables
+ALWAYS_INCLUDED = ('calendarYear',)
+
+# Requests with a correct query, to check that pruning the schema does not cost SQL accuracy
+ACCURACY_CASES = [
+    ("Show me the revenue of TCS in the past 3 years.",
+     '''SELECT "calendarYear", "revenue" FROM income_statement WHERE "symbol" = 'TCS' AND "period" = 'FY' ORDER BY "calendarYear" DESC LIMIT 3;'''),
+    ("What was the net income of INFY in 2023?",
+     '''SELECT "netIncome" FROM income_statement WHERE "symbol" = 'INFY' AND "calendarYear" = 2023 AND "period" = 'FY';'''),
+    ("Which 5 companies had the highest total debt in 2023?",
+     '''SELECT "symbol", "totalDebt" FROM balancesheet_statement WHERE "calendarYear" = 2023 AND "period" = 'FY' ORDER BY "totalDebt" DESC LIMIT 5;'''),
+    ("Free cash flow of WIPRO for every year",
+     '''SELECT "calendarYear", "freeCashFlow" FROM cashflow_statement WHERE "symbol" = 'WIPRO' AND "period" = 'FY' ORDER BY "calendarYear";'''),
+    ("Show the daily close and volume of RELIANCE in June 2024",
+     '''SELECT "date", "close", "volume" FROM stock_prices WHERE "symbol" = 'RELIANCE' AND "date" BETWEEN '2024-06-01' AND '2024-06-30' ORDER BY "date";'''),
+    ("Plot the monthly close of HDFCBANK in 2023",
+     '''SELECT "period_start", "close" FROM prices_monthly WHERE "symbol" = 'HDFCBANK' AND "period_start" BETWEEN '2023-01-01' AND '2023-12-31' ORDER BY "period_start";'''),
+    ("What is the PE ratio of TCS at the end of 2023?",
+     '''SELECT "date", "pe" FROM valuation WHERE "symbol" = 'TCS' AND "date" <= '2023-12-31' ORDER BY "date" DESC LIMIT 1;'''),
+    ("How deep was the drawdown of ITC in 2022?",
+     '''SELECT "date", "drawdown" FROM price_metrics WHERE "symbol" = 'ITC' AND "date" BETWEEN '2022-01-01' AND '2022-12-31' ORDER BY "drawdown" LIMIT 10;'''),
+]
+
+
+# Embedding models loaded so far, by name
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def load_encoder(model_name=EMBEDDING_MODEL):
+    """Sentence embedding model, loaded once per process and shared by the schema retriever and the LLM cache.
+
+    The lock keeps a request from loading the model a second time while the background warmup is loading it.
+    """
+    with _encoders_lock:
+        if model_name not in _encoders:
+            from sentence_transformers import SentenceTransformer
+            _encoders[model_name] = SentenceTransformer(model_name)
+        return _encoders[model_name]
+
+
+def embed(texts, model_name=EMBEDDING_MODEL):
+    """Unit-length float32 embeddings of `texts`, one row per text."""
+    return load_encoder(model_name).encode(list(texts), normalize_embeddings=True).astype(np.float32)
+
+
+def words(name):
+    """'totalStockholdersEquity' -> 'total stockholders equity', 'prices_weekly' -> 'prices weekly'."""
+    return re.sub(r'(?<=[a-z0-9])(?=[A-Z])|_', ' ', name).lower()
+
+
+class SchemaRetriever:
+
+    def __init__(self, db_path='stock_db.sqlite', tables=PROMPT_TABLES, top_tables=TOP_TABLES, top_columns=TOP_COLUMNS,
+                 model_name=EMBEDDING_MODEL, background=False):
+        self.top_tables = top_tables
+        self.top_columns = top_columns
+        self.model_name = model_name
+        self.db_path = db_path
+        self.tables = tables
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            self.schemas = {table: declared_schema(conn, table) for table in tables}
+            self.keys = {table: [row[1] for row in conn.execute(f"PRAGMA table_info({table})") if row[5]] for table in tables}
+        self.schemas = {table: schema for table, schema in self.schemas.items() if schema}
+        self.columns = [(table, column) for table, schema in self.schemas.items() for column in schema]
+        self.fingerprint = f"schema top {top_tables} tables x {top_columns} columns, {model_name}"
+
+        # Loading the embedding model takes seconds, in the background it does not hold up the app start
+        self._embedded = threading.Event()
+        self._error = None
+        if background:
+            threading.Thread(target=self._embed_schema, name='schema-embeddings', daemon=True).start()
+        else:
+            self._embed_schema()
+            self.wait()
+
+    def _embed_schema(self):
+        # One document per table and one per column, embedded in a single batch
+        table_docs = [f"{words(table)} table: {TABLE_NOTES.get(table, ', '.join(map(words, schema)))}"
+                      for table, schema in self.schemas.items()]
+        column_docs = [f"{words(column)} ({datatype}) in the {words(table)} table"
+                       for table, column in self.columns for datatype in [self.schemas[table][column]]]
+        try:
+            vectors = embed(table_docs + column_docs, self.model_name)
+            self.table_vectors, self.column_vectors = vectors[:len(table_docs)], vectors[len(table_docs):]
+        except Exception as e:
+            # e.g. sentence-transformers not installed or the model download failed: the prompts get the full schema
+            self._error = e
+            print(f"Schema embedding failed ({e!r}), the prompts describe the full schema.")
+        finally:
+            self._embedded.set()
+
+    def wait(self):
+        """Block until the schema is embedded, return False if the embedding failed."""
+        self._embedded.wait()
+        return self._error is None
+
+    def select(self, request):
+        """{table: [columns]} most relevant to `request`, tables by relevance and columns in their declared order."""
+        if not self.wait():
+            raise self._error
+        query = embed([request], self.model_name)[0]
+        column_scores = self.column_vectors @ query
+        tables = list(self.schemas)
+        # A table is as relevant as its own description or its best matching column
+        best_column = {table: -1.0 for table in tables}
+        for (table, _), score in zip(self.columns, column_scores):
+            best_column[table] = max(best_column[table], score)
+        table_scores = np.maximum(self.table_vectors @ query, [best_column[table] for table in tables])
+
+        # Tables or columns named verbatim in the request are always kept
+        mentioned = {word.lower() for word in re.findall(r'\w+', request)}
+        ranked = sorted(range(len(tables)), key=lambda i: (tables[i].lower() not in mentioned, -table_scores[i]))
+        selected = {}
+        for i in ranked[:self.top_tables]:
+            table = tables[i]
+            scores = {column: score for (t, column), score in zip(self.columns, column_scores) if t == table}
+            top = sorted(scores, key=lambda column: (column.lower() not in mentioned, -scores[column]))[:self.top_columns]
+            keep = set(top) | set(self.keys[table]) | set(ALWAYS_INCLUDED)
+            selected[table] = [column for column in self.schemas[table] if column in keep]
+        return selected
+
+    def describe(self, request):
+        """Pruned schema for the prompts: the list of all tables, then the DDL of the selected tables and columns."""
+        if not self.wait():
+            return describe_tables(self.db_path, self.tables)
+        lines = [f"-- tables in the database: {', '.join(self.schemas)}"]
+        for table, columns in self.select(request).items():
+            lines += table_ddl(table, {column: self.schemas[table][column] for column in columns})
+        return '\n'.join(lines)
+
+
+def prompt_size_report(db_path, requests):
+    """Tokens of the full schema vs the pruned schema of each request, as sent in the prompts."""
+    import tiktoken
+    encoding = tiktoken.encoding_for_model('gpt-4o-mini')
+    full = len(encoding.encode(describe_tables(db_path)))
+    retriever = SchemaRetriever(db_path)
+    print(f"Full schema: {full} tokens")
+    for request in requests:
+        pruned = retriever.describe(request)
+        print(f"\n{len(encoding.encode(pruned))} tokens ({full / len(encoding.encode(pruned)):.1f}x smaller): {request}")
+        for table, columns in retriever.select(request).items():
+            print(f"    {table}: {', '.join(columns)}")
+
+
+def query_identifiers(sql):
+    """(tables, columns) of a query written like the prompts ask: tables after FROM / JOIN, columns double-quoted."""
+    return set(re.findall(r'\b(?:FROM|JOIN)\s+"?(\w+)', sql, re.IGNORECASE)), set(re.findall(r'"(\w+)"', sql))
+
+
+def result_rows(conn, sql):
+    """The rows of `sql` as a sorted list, with each row's values sorted and floats rounded, None if the query fails."""
+    from query_runner import clean_sql
+    try:
+        rows = conn.execute(clean_sql(sql)).fetchall()
+    except sqlite3.Error:
+        return None
+    normalized = [sorted((round(value, 6) if isinstance(value, float) else value for value in row), key=repr) for row in rows]
+    return sorted(normalized, key=repr)
+
+
+def accuracy_report(db_path, cases=ACCURACY_CASES, llm=False):
+    """Check that the pruned schema keeps every table and column the correct query of each case uses.
+
+    With `llm` the SQL chain prompt of app.py is also run with the pruned and with the full schema, and each generated
+    query counts as accurate if it returns the same rows as the correct one. Returns True if the pruned schema keeps
+    every needed column and is at least as accurate as the full schema.
+    """
+    retriever = SchemaRetriever(db_path)
+    if llm:
+        from langchain_core.output_parsers import StrOutputParser
+        import app
+        generate = app.PROMPT1 | app.llm | StrOutputParser()
+    kept, accurate = 0, {'pruned': 0, 'full': 0}
+    with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+        for request, reference in cases:
+            tables, columns = query_identifiers(reference)
+            selected = retriever.select(request)
+            available = {column for table in tables for column in selected.get(table, [])}
+            missing = sorted(tables - set(selected)) or sorted(columns - available)
+            kept += not missing
+            print(f"\n{'ok' if not missing else 'MISSING ' + ', '.join(missing)}: {request}")
+            if llm:
+                expected = result_rows(conn, reference)
+                for name, schema in (('pruned', retriever.describe(request)), ('full', describe_tables(db_path))):
+                    sql = generate.invoke({'request': request, 'schema': schema})
+                    same = result_rows(conn, sql) == expected
+                    accurate[name] += same
+                    print(f"    {name} schema: {'same rows' if same else 'WRONG'}: {' '.join(sql.split())}")
+    if llm:
+        # The app's code execution workers are not used here
+        app.execution_pool.close()
+    print(f"\nPruned schema keeps the needed columns of {kept}/{len(cases)} requests.")
+    if llm:
+        print(f"Generated SQL returns the correct rows for {accurate['pruned']}/{len(cases)} requests with the pruned "
+              f"schema, {accurate['full']}/{len(cases)} with the full schema.")
+    return kept == len(cases) and accurate['pruned'] >= accurate['full']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prompt size and SQL accuracy of the pruned schema")
+    parser.add_argument('requests', nargs='*', default=["Show me the revenue of IT companies in the past 3 years."])
+    parser.add_argument('--accuracy', action='store_true', help="check the pruned schema against correct queries")
+    parser.add_argument('--llm', action='store_true', help="also generate the SQL with the LLM (needs OPENAI_KEY)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.accuracy:
+        raise SystemExit(0 if accuracy_report('stock_db.sqlite', llm=args.llm) else 1)
+    prompt_size_report('stock_db.sqlite', args.requests)
@@ -0,0 +1,108 @@
+### Cold start of app.py: background warmup, the DB check of the image build, and an import-time profile
+# app.py only builds its chains at import and hands the slow parts (embedding model, pandas, SQLite page cache,
+# execution workers) to a background thread, so Chainlit accepts connections right away.
+# Usage:
+#     warm_up_in_background(("page cache", lambda: prefetch_files(['stock_db.sqlite'])), ...)
+#     python startup.py --check stock_db.sqlite      # integrity check, exits with an error on a corrupt or empty DB
+#     python startup.py --profile [module]           # import time of app.py (or module), slowest imports first
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+import subprocess
+from contextlib import closing
+
+
+# Bytes read at a time when the OS cannot be asked to read a file ahead
+READ_CHUNK = 1 << 20
+
+
+def prefetch_files(paths):
+    """Pull files into the OS page cache, so the first queries (and the price cube) are not served from disk."""
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                while f.read(READ_CHUNK):
+                    pass
+
+
+def warm_up_in_background(*tasks):
+    """Run the (name, function) tasks one after the other in a daemon thread, print how long each took."""
+    def run():
+        started = time.perf_counter()
+        for name, task in tasks:
+            step = time.perf_counter()
+            try:
+                task()
+            except Exception as e:
+                # A failed warmup only costs the first request its latency, that request reports the error
+                print(f"Warmup of the {name} failed: {e!r}")
+            else:
+                print(f"Warmup of the {name} done in {time.perf_counter() - step:.2f}s")
+        print(f"Warmup done in {time.perf_counter() - started:.2f}s")
+
+    thread = threading.Thread(target=run, name='warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def check_db(db_path, tables=None):
+    """Raise SystemExit unless the DB passes SQLite's integrity_check and has rows in every table the prompts describe."""
+    from schema import PROMPT_TABLES
+    if not os.path.exists(db_path):
+        raise SystemExit(f"'{db_path}' does not exist, run main.py first.")
+    with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+        if problems != ['ok']:
+            raise SystemExit(f"'{db_path}' is corrupt: {'; '.join(problems[:10])}")
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        empty = [table for table in tables or PROMPT_TABLES
+                 if table not in existing or not conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()]
+    if empty:
+        raise SystemExit(f"'{db_path}' has no rows in: {', '.join(empty)}. Rebuild it with main.py.")
+    print(f"'{db_path}' is OK.")
+
+
+def import_profile(module='app', top=20):
+    """Import `module` in a fresh interpreter with -X importtime, print its total and the slowest top-level imports."""
+    env = {'OPENAI_KEY': 'profile', **os.environ}
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], env=env,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode:
+        raise SystemExit(result.stderr[-2000:])
+
+    # Lines are 'import time: <self us> | <cumulative us> | <indented module>', the indent is the nesting depth
+    imports = []
+    for self_us, cumulative_us, name in re.findall(r'^import time:\s+(\d+) \|\s+(\d+) \|( +\S+)$', result.stderr, re.MULTILINE):
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((int(cumulative_us) / 1e6, int(self_us) / 1e6, depth, name.strip()))
+    total = next((cumulative for cumulative, _, depth, name in imports if depth == 0 and name == module), 0)
+    print(f"import {module}: {total:.2f}s (process {elapsed:.2f}s, includes the interpreter start)")
+    print(f"{'cumulative':>10} {'self':>8}  module imported by {module}")
+    direct = sorted((entry for entry in imports if entry[2] == 1), reverse=True)
+    for cumulative, self_time, _, name in direct[:top]:
+        print(f"{cumulative:>9.3f}s {self_time:>7.3f}s  {name}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cold start checks of app.py")
+    parser.add_argument('--check', metavar='DB', help="check the integrity and the tables of a DB")
+    parser.add_argument('--profile', metavar='MODULE', nargs='?', const='app', help="import-time profile of a module")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.check:
+        check_db(args.check)
+    if args.profile:
+        import_profile(args.profile)
@@ -0,0 +1,210 @@
+### Per-request tracing of the app.py pipeline: stage timings, LLM tokens, cache hits, SQL rows and errors
+# Each request gets a RequestTrace, held in a context variable so the stages (and the LLM callback counting the
+# tokens) record into it from anywhere in the request, including the tasks it gathers. A finished trace is written
+# as one JSON line to TRACE_LOG_PATH and added to the Prometheus-style metrics returned by `metrics_text()`.
+# Usage:
+#     trace = start_trace(request)
+#     with stage('sql_execution') as record:
+#         df = run(sql)
+#         record['rows'] = len(df)
+#     finish_trace(trace)
+#     llm = ChatOpenAI(..., callbacks=[TokenCounter()])      # prompt / completion tokens of the current stage
+import os
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+from langchain_core.callbacks import AsyncCallbackHandler
+
+
+# Settings, overridable through environment variables
+TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH', 'traces.jsonl')          # empty: no structured log
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+# Upper bounds of the SQL rows histogram buckets
+ROWS_BUCKETS = (0, 10, 100, 1000, 10_000, 100_000, 1_000_000)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+
+
+class RequestTrace:
+
+    def __init__(self, request):
+        self.request = request
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.seconds = None
+        self.stages = []
+        self.values = {}            # request-level values, e.g. the time to first token
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {'started': self.started, 'request': self.request, 'seconds': self.seconds, **self.values,
+                'stages': self.stages}
+
+
+def start_trace(request):
+    """New trace for `request`, current for the rest of the calling task (and the tasks it starts)."""
+    trace = RequestTrace(request)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name, **values):
+    """Time one stage of the current request, the yielded dict takes the stage values (rows, cache, ...).
+
+    An exception raised in the stage is recorded as its error and re-raised. Nothing is recorded outside a trace.
+    """
+    record = {'stage': name, **values}
+    token = _current_stage.set(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - started, 4)
+        _current_stage.reset(token)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.stages.append(record)
+
+
+def record_value(key, value):
+    """Set a value on the current stage, or on the request when no stage is running."""
+    record = _current_stage.get()
+    if record is not None:
+        record[key] = value
+    elif _current_trace.get() is not None:
+        _current_trace.get().values[key] = value
+
+
+class TokenCounter(AsyncCallbackHandler):
+    """LLM callback adding the prompt and completion tokens of every call to the stage it runs in."""
+
+    async def on_llm_end(self, response, **kwargs):
+        record = _current_stage.get()
+        if record is None:
+            return
+        tokens_in = tokens_out = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    tokens_in += usage.get('input_tokens', 0)
+                    tokens_out += usage.get('output_tokens', 0)
+        if not tokens_in and not tokens_out:
+            # Non-streamed calls of older clients only report the usage of the whole call
+            usage = (response.llm_output or {}).get('token_usage') or {}
+            tokens_in, tokens_out = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        record['prompt_tokens'] = record.get('prompt_tokens', 0) + tokens_in
+        record['completion_tokens'] = record.get('completion_tokens', 0) + tokens_out
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)          # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        lines, total = [], 0
+        for bound, count in zip([*map(str, self.buckets), '+Inf'], self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {total}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines += [f'{name}_sum{suffix} {self.sum:g}', f'{name}_count{suffix} {total}']
+        return lines
+
+
+class Metrics:
+    """Aggregates of the finished traces, in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.request_seconds = Histogram(LATENCY_BUCKETS)
+        self.stage_seconds = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.ttft_seconds = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.tokens = defaultdict(int)              # (stage, 'prompt' | 'completion') -> tokens
+        self.cache = defaultdict(int)               # (stage, 'hit' | 'miss') -> lookups
+        self.errors = defaultdict(int)              # stage -> errors
+        self.sql_rows = Histogram(ROWS_BUCKETS)
+
+    def add(self, trace):
+        with self._lock:
+            self.requests += 1
+            self.request_seconds.observe(trace.seconds)
+            if 'error' in trace.values:
+                self.errors['request'] += 1
+            for key, value in trace.values.items():
+                if key.startswith('ttft_') and value is not None:
+                    self.ttft_seconds[key[len('ttft_'):]].observe(value)
+            for record in trace.stages:
+                name = record['stage']
+                self.stage_seconds[name].observe(record['seconds'])
+                self.tokens[name, 'prompt'] += record.get('prompt_tokens', 0)
+                self.tokens[name, 'completion'] += record.get('completion_tokens', 0)
+                if 'cache' in record:
+                    self.cache[name, record['cache']] += 1
+                if 'error' in record:
+                    self.errors[name] += 1
+                if 'rows' in record:
+                    self.sql_rows.observe(record['rows'])
+
+    def text(self):
+        with self._lock:
+            lines = ['# TYPE app_requests_total counter', f'app_requests_total {self.requests}',
+                     '# TYPE app_request_seconds histogram', *self.request_seconds.lines('app_request_seconds', '')]
+            lines.append('# TYPE app_time_to_first_token_seconds histogram')
+            for message, histogram in sorted(self.ttft_seconds.items()):
+                lines += histogram.lines('app_time_to_first_token_seconds', f'message="{message}"')
+            lines.append('# TYPE app_stage_seconds histogram')
+            for name, histogram in sorted(self.stage_seconds.items()):
+                lines += histogram.lines('app_stage_seconds', f'stage="{name}"')
+            lines.append('# TYPE app_llm_tokens_total counter')
+            lines += [f'app_llm_tokens_total{{stage="{name}",kind="{kind}"}} {count}'
+                      for (name, kind), count in sorted(self.tokens.items()) if count]
+            lines.append('# TYPE app_cache_lookups_total counter')
+            lines += [f'app_cache_lookups_total{{stage="{name}",result="{result}"}} {count}'
+                      for (name, result), count in sorted(self.cache.items())]
+            lines.append('# TYPE app_stage_errors_total counter')
+            lines += [f'app_stage_errors_total{{stage="{name}"}} {count}' for name, count in sorted(self.errors.items())]
+            lines += ['# TYPE app_sql_rows histogram', *self.sql_rows.lines('app_sql_rows', '')]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+_log_lock = threading.Lock()
+
+
+def finish_trace(trace, log_path=TRACE_LOG_PATH):
+    """Close the trace: add it to the metrics and append it to the structured log."""
+    trace.seconds = round(trace.elapsed(), 4)
+    metrics.add(trace)
+    if log_path:
+        line = json.dumps(trace.to_dict(), default=str)
+        with _log_lock, open(log_path, 'a') as f:
+            f.write(line + '\n')
+
+
+def metrics_text():
+    return metrics.text()